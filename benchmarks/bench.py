@@ -0,0 +1,238 @@
+"""
+Benchmarks of garbling, evaluation, oblivious transfers and whole sessions.
+
+Results are written as JSON, one record per measurement, so that runs can
+be compared over time:
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --quick
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mpc.client.client import SocketClient  # noqa: E402
+from mpc.client.protocols import OTExtension as OTExtensionReceiver  # noqa: E402
+from mpc.client.protocols import YaoGarbledCircuit  # noqa: E402
+from mpc.client.protocols import YaoObliviousTransfer as YaoObliviousTransferReceiver  # noqa: E402
+from mpc.common.connection import frame_size, marshall_request  # noqa: E402
+from mpc.common.protocols import GarbledCircuit  # noqa: E402
+from mpc.server._protocols import OTExtension, YaoObliviousTransfer  # noqa: E402
+from mpc.server._lifecycle import Lifecycle  # noqa: E402
+from mpc.server._server import Server  # noqa: E402
+
+ENGINES = (
+    {'engine': 'fernet', 'free_xor': False},
+    {'engine': 'fernet', 'free_xor': True},
+    {'engine': 'half-gates', 'free_xor': True},
+)
+
+
+def random_circuit(num_inputs, num_gates, xor_ratio, seed=0):
+    """
+    Random circuit whose gates read the inputs and the previous gates.
+        Parameters:
+            num_inputs: number of input wires of each party
+            num_gates: number of gates
+            xor_ratio: fraction of XOR gates, the others are AND gates
+        Returns:
+            circuit: dict
+                circuit spec
+    """
+    rand = random.Random(seed)
+    wires = list(range(2 * num_inputs))
+    gates = []
+    for i in range(num_gates):
+        gate_type = "XOR" if rand.random() < xor_ratio else "AND"
+        # the first gates read every input once
+        gate_in = [i, num_inputs + i] if i < num_inputs else rand.sample(wires[-4 * num_inputs:], 2)
+        gates.append({"id": len(wires), "type": gate_type, "in": gate_in})
+        wires.append(len(wires))
+    return {
+        "name": "random {0} {1}".format(num_gates, xor_ratio),
+        "alice": list(range(num_inputs)),
+        "bob": list(range(num_inputs, 2 * num_inputs)),
+        "out": wires[-num_inputs:],
+        "gates": gates,
+    }
+
+
+class LocalClient(object):
+    """
+    Delivers the requests of a protocol to local objects, in place of a SocketClient,
+    so that only the computation of the protocol is measured.
+    """
+
+    def __init__(self, protocols):
+        self.protocols = protocols
+        self.response = None
+
+    def send(self, app, method, **kwargs):
+        self.response = getattr(self.protocols[app], method)(**kwargs)
+
+    def receive(self):
+        return self.response
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_circuits(sizes, xor_ratios):
+    results = []
+    for num_gates in sizes:
+        for xor_ratio in xor_ratios:
+            spec = random_circuit(32, num_gates, xor_ratio)
+            inputs = [random.randint(0, 1) for _ in spec['alice']]
+            for options in ENGINES:
+                seconds, circuit = timed(GarbledCircuit, spec, **options)
+                a_inputs = circuit.encode_labels(inputs, spec['alice'])
+                b_inputs = circuit.encode_labels(inputs, spec['bob'])
+                evaluation, _ = timed(GarbledCircuit.evaluate, spec, circuit.garbled_tables, circuit.out_p_bits,
+                                      a_inputs, b_inputs, **options)
+                # the request of the garbler carrying the circuit and its tables
+                message = marshall_request('YaoGarbledCircuit', 'circuit_input', circuit=spec,
+                                           table=circuit.garbled_tables.dump(), output_p_bits=circuit.out_p_bits)
+                tables = len(circuit.garbled_tables)
+                record = dict(options, gates=num_gates, xor_ratio=xor_ratio)
+                results.append(dict(record, name='garble', seconds=seconds, gates_per_s=num_gates / seconds))
+                results.append(dict(record, name='evaluate', seconds=evaluation, gates_per_s=num_gates / evaluation))
+                results.append(dict(record, name='wire', table_bytes_per_gate=tables / num_gates,
+                                    message_bytes_per_gate=frame_size(message) / num_gates))
+    return results
+
+
+def bench_ot(counts):
+    results = []
+    for count in counts:
+        messages = [(os.urandom(16), os.urandom(16)) for _ in range(count)]
+        choices = [random.randint(0, 1) for _ in range(count)]
+
+        sender = YaoObliviousTransfer(messages)
+        receiver = YaoObliviousTransferReceiver(LocalClient({'YaoObliviousTransfer': sender}))
+        seconds, _ = timed(receiver.run_batch, choices)
+        results.append({'name': 'ot', 'protocol': 'bellare-micali', 'ots': count, 'seconds': seconds,
+                        'ots_per_s': count / seconds})
+
+        sender = OTExtension(messages)
+        receiver = OTExtensionReceiver(LocalClient({'OTExtension': sender}))
+        setup, _ = timed(receiver.setup)
+        seconds, _ = timed(receiver.run, choices)
+        results.append({'name': 'ot', 'protocol': 'iknp', 'ots': count, 'setup_seconds': setup, 'seconds': seconds,
+                        'ots_per_s': count / seconds})
+    return results
+
+
+def start_server(lifecycle, timeout=10.0):
+    """
+    Runs a server in a background thread and waits until it accepts connections.
+        Parameters:
+            lifecycle: Lifecycle of the server, holding its properties
+            timeout: seconds to wait for the server
+        Returns:
+            port: the port of the server
+        Raises:
+            RuntimeError: if the server failed to start
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    errors = []
+
+    def run():
+        try:
+            Server(lifecycle=lifecycle).run(port=port)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while True:
+        if errors or not thread.is_alive():
+            raise RuntimeError("the server failed to start: {0!r}".format(errors[0] if errors else None))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return port
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("the server did not listen on port {0} within {1}s".format(port, timeout))
+            time.sleep(0.05)
+
+
+def bench_sessions(sizes, repeat):
+    # Bob's inputs are the properties of the server, loaded once by its Lifecycle
+    num_inputs = 32
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'properties.json')
+        with open(path, 'w') as f:
+            json.dump({'YaoGarbledCircuit': {'inputs': [1] * num_inputs}}, f)
+        lifecycle = Lifecycle(path)
+
+    port = start_server(lifecycle)
+
+    results = []
+    for num_gates in sizes:
+        spec = random_circuit(num_inputs, num_gates, 0.5)
+        for options in ENGINES:
+            latencies = []
+            for _ in range(repeat):
+                client = SocketClient(host='127.0.0.1', port=port)
+                protocol = YaoGarbledCircuit(client, YaoObliviousTransfer(), **options)
+                with client:
+                    seconds, _ = timed(protocol.run, spec, [0] * num_inputs)
+                latencies.append(seconds)
+            latencies.sort()
+            results.append(dict(options, name='session', gates=num_gates, repeat=repeat,
+                                median_seconds=latencies[len(latencies) // 2], min_seconds=latencies[0]))
+
+            # the same number of evaluations as one batch over a single connection
+            client = SocketClient(host='127.0.0.1', port=port)
+            protocol = YaoGarbledCircuit(client, YaoObliviousTransfer(), **options)
+            with client:
+                seconds, _ = timed(protocol.run_batch, spec, [[0] * num_inputs] * repeat)
+            results.append(dict(options, name='batch', gates=num_gates, instances=repeat, seconds=seconds,
+                                instances_per_s=repeat / seconds))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='file receiving the JSON results, stdout by default')
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    args = parser.parse_args()
+
+    sizes = [100, 1000] if args.quick else [1000, 10000, 100000]
+    ots = [100] if args.quick else [100, 1000, 10000]
+    sessions = [100] if args.quick else [100, 1000, 10000]
+
+    results = bench_circuits(sizes, [0.0, 0.5, 0.9])
+    results += bench_ot(ots)
+    results += bench_sessions(sessions, 3 if args.quick else 5)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,15 @@
 import asyncio
+import collections
+import itertools
 import socket
+import threading
 
-from mpc.common.connection import marshall_request, unmarshall_response
+from mpc.common.connection import (BUFFER_SIZE, END, RESPONSE, FrameError, SessionChannel, marshall_end,
+                                   marshall_request, marshall_response, receive_envelope, receive_frame, send_message,
+                                   unmarshall_response)
+
+# connections kept open by a ConnectionPool
+POOL_SIZE = 4
 
 
 # class AsyncClient(object):
@@ -32,12 +40,26 @@ from mpc.common.connection import marshall_request, unmarshall_response
 
 
 class SocketClient(object):
+    """
+        Client of one session, over its own socket or over a SessionChannel
+        of a multiplexed connection.
+        Requests are numbered, and their responses carry the same id: a
+        response has to answer a request in flight, and answers the requests
+        sent before it that get no response of their own. An END frame of the
+        other party, which ends the session on an error, raises a
+        ConnectionAbortedError.
+    """
 
-    def __init__(self, socket=None, host=None, port=None):
+    def __init__(self, socket=None, host=None, port=None, session_id=0):
         assert not all((socket, host, port))
         self.socket = socket
         self.host = host
         self.port = port
+        self.session_id = session_id
+        self.request_id = 0  # id of the last request sent
+        self.pending = collections.deque()  # ids of the requests without a response, oldest first
+        self.received_id = 0  # id of the last message received
+        self.buffer = bytearray(BUFFER_SIZE)
 
     def __enter__(self):
         self.connect()
@@ -52,12 +74,156 @@ class SocketClient(object):
             self.socket.connect((self.host, self.port))
 
     def send(self, *args, **kwargs):
-        message = marshall_request(*args, **kwargs)
-        self.socket.send(message)
+        self.request_id += 1
+        message = marshall_request(*args, session_id=self.session_id, request_id=self.request_id, **kwargs)
+        send_message(self.socket, message)
+        self.pending.append(self.request_id)
+
+    def respond(self, **kwargs):
+        # answers the last request received from the other party
+        send_message(self.socket, marshall_response(self.session_id, self.received_id, **kwargs))
 
     def receive(self):
-        data = self.socket.recv(10000)
+        message_type, _, self.received_id, data = receive_envelope(self.socket, self.buffer)
+        if message_type == END:
+            raise ConnectionAbortedError("Session {0} ended by the other party".format(self.session_id))
+        if message_type == RESPONSE:
+            if self.received_id not in self.pending:
+                raise FrameError("Response to request {0}, which is not in flight".format(self.received_id))
+            while self.pending.popleft() != self.received_id:
+                pass
         return unmarshall_response(data)
 
     def close(self):
         self.socket.close()
+
+
+class ConnectionPool(object):
+    """
+        Connections to a server kept open and shared by many sessions.
+        Each session is a SocketClient on a SessionChannel of one of the
+        connections; a reader thread per connection routes the incoming
+        frames to the sessions by id, so that sessions run concurrently
+        and their messages interleave on the wire. The asynchronous server
+        runs the sessions of a connection concurrently, the synchronous one
+        serves their requests one at a time.
+        Connections whose reader has stopped are dropped, and replaced by
+        new ones for the next sessions.
+        Parameters:
+            host, port: address of the server
+            size: int
+                number of connections
+    """
+
+    def __init__(self, host, port, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connections = []
+        self.connecting = 0  # connections being opened
+        self.session_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.connected = threading.Condition(self.lock)  # notified when a connection is opened or fails
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def client(self):
+        """
+            Opens a session on the least busy connection, opening a new one
+            while there are fewer than size.
+            Returns:
+                client: SocketClient of the session, closing it ends the session
+        """
+        with self.lock:
+            session_id = next(self.session_ids)
+            while True:
+                self.connections = [c for c in self.connections if not c.closed]
+                connect = len(self.connections) + self.connecting < self.size
+                if connect or self.connections:
+                    break
+                # the connections are all being opened
+                self.connected.wait()
+            if connect:
+                self.connecting += 1
+            else:
+                connection = min(self.connections, key=len)
+        if connect:
+            # connects outside of the lock, the other sessions use the open connections meanwhile
+            try:
+                connection = _Connection(self.host, self.port)
+                with self.lock:
+                    self.connections.append(connection)
+            finally:
+                with self.lock:
+                    self.connecting -= 1
+                    self.connected.notify_all()
+        return SocketClient(socket=connection.open(session_id), session_id=session_id)
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+
+class _Connection(object):
+    # connection of a pool and the channels of its sessions
+
+    def __init__(self, host, port):
+        self.socket = socket.create_connection((host, port))
+        self.channels = {}  # session id -> SessionChannel
+        self.closed = False  # set once the reader has stopped
+        self.lock = threading.Lock()  # serializes the frames written
+        self.channels_lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def __len__(self):
+        return len(self.channels)
+
+    def open(self, session_id):
+        channel = SessionChannel(self.write, lambda: self.end(session_id))
+        with self.channels_lock:
+            if self.closed:
+                raise ConnectionAbortedError("Connection closed")
+            self.channels[session_id] = channel
+        return channel
+
+    def write(self, frame):
+        with self.lock:
+            send_message(self.socket, frame)
+
+    def end(self, session_id):
+        with self.channels_lock:
+            self.channels.pop(session_id, None)
+            if self.closed:
+                return
+        self.write(marshall_end(session_id))
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def _read(self):
+        try:
+            while True:
+                _, session_id, frame = receive_frame(self.socket)
+                with self.channels_lock:
+                    channel = self.channels.get(session_id)
+                if channel is not None:
+                    channel.put(frame)
+        except (ConnectionAbortedError, OSError):
+            pass
+        finally:
+            with self.channels_lock:
+                self.closed = True
+                channels = list(self.channels.values())
+            for channel in channels:
+                channel.put(None)
@@ -1,9 +1,9 @@
-import codecs
-import json
-import pickle
+import secrets
 
-from mpc.common.crypto import xor_bytes, ot_hash
-from mpc.common.protocols import GarbledCircuit
+from mpc.common.crypto import DEFAULT_GROUP, GROUPS, xor_bytes
+from mpc.common.instrumentation import metrics
+from mpc.common.ot import FIXED_BASE_BATCH, SECURITY_BITS, SEED_BYTES, choose_key, decrypt_message, encrypt_messages, prg, row_hash, to_bytes, transpose
+from mpc.common.protocols import GarbledCircuit, pack_label
 
 
 class ObliviousTransfer(object):
@@ -32,11 +32,41 @@ class ObliviousTransfer(object):
         rand_ints = self.get_random_integers()
         xb = rand_ints[b]
         k = self.random(xb)
-        v = (xb + k ** e) % n
+        v = (xb + pow(k, e, n)) % n
         ms = self.get_integers(v)
         m_b = ms[b] - k
         return m_b
 
+    def get_batch_integers(self):
+        self.client.send(self.__class__.__name__, self.get_batch_integers.__name__)
+        res = self.client.receive()
+        return res['n'], res['e'], res['x']
+
+    def get_batch_messages(self, v):
+        self.client.send(self.__class__.__name__, self.get_batch_messages.__name__, v=v)
+        res = self.client.receive()
+        return res['m']
+
+    def run_batch(self, choices):
+        """
+            Runs one 1-out-of-n OT per choice in two round trips,
+            all under the same RSA key of the sender.
+            Parameters:
+                choices: list of the indices of the chosen messages
+            Returns:
+                messages: list of the chosen messages
+        """
+        if not choices:
+            return []
+        metrics.count('ots', len(choices), protocol='rsa')
+        with metrics.span('ot_batch', protocol='rsa'):
+            n, e, x = self.get_batch_integers()
+            xb = [x_j[b] for x_j, b in zip(x, choices)]
+            k = [self.random(x_b) for x_b in xb]
+            v = [(x_b + pow(k_j, e, n)) % n for x_b, k_j in zip(xb, k)]
+            ms = self.get_batch_messages(v)
+            return [m_j[b] - k_j for m_j, b, k_j in zip(ms, choices, k)]
+
 
 class YaoObliviousTransfer(object):
 
@@ -46,28 +76,116 @@ class YaoObliviousTransfer(object):
     def get_keys(self):
         self.client.send(self.__class__.__name__, self.get_keys.__name__)
         res = self.client.receive()
-        g = pickle.loads(codecs.decode(res['g'].encode(), "base64"))
+        g = GROUPS.from_params(res['g'])
         return g, res['c']
 
     def get_messages(self, h):
         self.client.send(self.__class__.__name__, self.get_messages.__name__, h=h)
         res = self.client.receive()
-        e0 = codecs.decode(res['e0'].encode(), 'base64')
-        e1 = codecs.decode(res['e1'].encode(), 'base64')
-        return res['c1'], e0, e1
+        return res['c1'], res['e0'], res['e1']
+
+    def get_batch_messages(self, h):
+        self.client.send(self.__class__.__name__, self.get_batch_messages.__name__, h=h)
+        res = self.client.receive()
+        return res['c1'], res['e0'], res['e1']
 
     def run(self, b):
-        g, c = self.get_keys()
-        x = g.rand_int()
-        h_b = g.gen_pow(x)
-        h_not_b = g.mul(c, g.inv(h_b))
-        if b:
-            c1, e0, e1 = self.get_messages(h_not_b)
-            mb = xor_bytes(e1, ot_hash(g.pow(c1, x), len(e1)))
-        else:
-            c1, e0, e1 = self.get_messages(h_b)
-            mb = xor_bytes(e0, ot_hash(g.pow(c1, x), len(e0)))
-        return mb
+        metrics.count('ots', protocol='bellare-micali')
+        with metrics.span('ot', protocol='bellare-micali'):
+            g, c = self.get_keys()
+            x, h = choose_key(g, c, b)
+            c1, e0, e1 = self.get_messages(h)
+            return decrypt_message(g, x, b, c1, e0, e1)
+
+    def run_batch(self, choices):
+        """
+            Runs one OT per choice bit in two round trips,
+            all sharing the group and the c value of the sender.
+            Parameters:
+                choices: list of choice bits
+            Returns:
+                messages: list of the chosen messages
+        """
+        if not choices:
+            return []
+        metrics.count('ots', len(choices), protocol='bellare-micali')
+        with metrics.span('ot_batch', protocol='bellare-micali'):
+            g, c = self.get_keys()
+            if len(choices) >= FIXED_BASE_BATCH:
+                g.precompute()
+            x, h = zip(*(choose_key(g, c, b) for b in choices))
+            c1, e0, e1 = self.get_batch_messages(list(h))
+            return [decrypt_message(g, *args) for args in zip(x, choices, c1, e0, e1)]
+
+
+class OTExtension(object):
+    """
+        Receiver of the IKNP OT extension.
+        SECURITY_BITS base OTs, where this side is the sender of random
+        seeds, are run once; every transfer after that only costs hashing.
+    """
+
+    def __init__(self, client, group=DEFAULT_GROUP):
+        self.client = client
+        self.group = group  # name of the group of the base OTs
+        self.seeds = None  # pairs of seeds of the base OTs
+        self.offset = 0  # number of transfers extended so far
+
+    def base_choose(self, g, c):
+        self.client.send(self.__class__.__name__, self.base_choose.__name__, g=g.params(), c=c)
+        res = self.client.receive()
+        return res['h']
+
+    def base_messages(self, c1, e0, e1):
+        # no reply, the next request is the extension itself
+        self.client.send(self.__class__.__name__, self.base_messages.__name__, c1=c1, e0=e0, e1=e1)
+
+    def extend(self, u):
+        self.client.send(self.__class__.__name__, self.extend.__name__, u=u)
+        res = self.client.receive()
+        return res['y0'], res['y1']
+
+    def setup(self):
+        # base OTs with the roles of sender and receiver swapped
+        with metrics.span('ot_setup', protocol='iknp'):
+            g = GROUPS.get(self.group)
+            c = g.gen_pow(g.rand_int())
+            self.seeds = [(secrets.token_bytes(SEED_BYTES), secrets.token_bytes(SEED_BYTES))
+                          for _ in range(SECURITY_BITS)]
+            hs = self.base_choose(g, c)
+            c_pow = g.fixed_base(c)
+            c1, e0, e1 = zip(*(encrypt_messages(g, c, h, seeds, c_pow) for h, seeds in zip(hs, self.seeds)))
+            self.base_messages(list(c1), list(e0), list(e1))
+            self.offset = 0
+
+    def run(self, choices):
+        """
+            Receives one message of each pair of the sender.
+            Parameters:
+                choices: list of choice bits
+            Returns:
+                messages: list of the chosen messages
+        """
+        if not choices:
+            return []
+        if self.seeds is None:
+            self.setup()
+
+        num_ots = len(choices)
+        metrics.count('ots', num_ots, protocol='iknp')
+        with metrics.span('ot_batch', protocol='iknp'):
+            r = sum(b << j for j, b in enumerate(choices))
+            columns = [prg(k0, self.offset, num_ots) for k0, _ in self.seeds]
+            u = [to_bytes(t_i ^ prg(k1, self.offset, num_ots) ^ r, num_ots)
+                 for t_i, (_, k1) in zip(columns, self.seeds)]
+            y0, y1 = self.extend(u)
+
+            messages = []
+            for j, (t_j, b) in enumerate(zip(transpose(columns, num_ots), choices)):
+                y = y1[j] if b else y0[j]
+                messages.append(xor_bytes(y, row_hash(self.offset + j, t_j, len(y))))
+            self.offset += num_ots
+            return messages
 
 
 def is_closed(data):
@@ -79,40 +197,119 @@ def is_closed(data):
 
 class YaoGarbledCircuit(object):
 
-    def __init__(self, client, oblivious_transfer):
+    def __init__(self, client, oblivious_transfer, free_xor=False, engine='fernet', chunk_size=None,
+                 ot_extension=None, pool=None):
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("Invalid chunk size {0}".format(chunk_size))
         self.oblivious_transfer = oblivious_transfer
+        # if set, Bob's keys are transferred with the OT extension
+        self.ot_extension = ot_extension
         self.client = client
+        self.free_xor = free_xor
+        self.engine = engine
+        # if set, tables are streamed in chunks of gates after the OT
+        self.chunk_size = chunk_size
+        # GarbledCircuitPool of circuits garbled offline, used unless streaming
+        self.pool = pool
         self.b_keys = None
-        self.switch = {'YaoGarbledCircuit': self, 'YaoObliviousTransfer': self.oblivious_transfer}
+        self.batch_keys = None  # Bob's keys of each instance of a batch
+        self.switch = {'YaoGarbledCircuit': self, 'YaoObliviousTransfer': self.oblivious_transfer,
+                       'OTExtension': self.ot_extension}
 
     def circuit_input(self, circuit, table, output_p_bits, active_labels):
         # Creates garbled circuit
         self.client.connect()
-        # json does not serialize tuple as key and bytes as any value
-        table = {k: [{'k': ki, 'h': vi.decode('utf-8')} for ki, vi in v.items()] for k, v in table.items()}
-        active_labels = {k: (v1.decode('utf-8'), v2) for k, (v1, v2) in active_labels.items()}
-        kwargs = dict(circuit=circuit, table=table, output_p_bits=output_p_bits, active_labels=active_labels)
+        # the garbled tables are sent as one buffer, unless they are streamed
+        table = table.dump() if table is not None else None
+        kwargs = dict(circuit=circuit, table=table, output_p_bits=output_p_bits, active_labels=active_labels,
+                      free_xor=self.free_xor, engine=self.engine, chunk_size=self.chunk_size,
+                      ot_extension=self.ot_extension is not None)
         self.client.send(self.__class__.__name__, self.circuit_input.__name__, **kwargs)
 
-    def ot(self, w):
-        secret = [pickle.dumps(k) for k in self.b_keys[w]]
-        self.oblivious_transfer.set_secrets(secret)
+    def circuit_chunks(self, circuit):
+        # Garbles the next chunk while the evaluator works on the previous ones
+        for table, output_p_bits in circuit.stream(self.chunk_size):
+            self.client.send(self.__class__.__name__, 'circuit_chunk', table=table.dump(), output_p_bits=output_p_bits)
+
+    def ot_batch(self, wires):
+        secrets = [[pack_label(*k) for k in self.b_keys[w]] for w in wires]
+        (self.ot_extension or self.oblivious_transfer).set_secrets(secrets)
+
+    def ot_instances(self, wires):
+        # Bob's wires of every instance of a batch, instance by instance
+        secrets = [[pack_label(*k) for k in keys[w]] for keys in self.batch_keys for w in wires]
+        (self.ot_extension or self.oblivious_transfer).set_secrets(secrets)
+
+    def garble(self, circuit_spec, stream=False):
+        circuit = None
+        if self.pool is not None and not stream:
+            circuit = self.pool.pop(circuit_spec, free_xor=self.free_xor, engine=self.engine)
+        if circuit is None:
+            circuit = GarbledCircuit(circuit_spec, free_xor=self.free_xor, engine=self.engine, stream=stream)
+        return circuit
+
+    def dispatch(self):
+        # serves the requests of the evaluator until it closes the exchange of keys
+        data = self.client.receive()
+        while not is_closed(data):
+            with metrics.span('handle', protocol=data['app'], method=data['method']):
+                res = getattr(self.switch[data['app']], data['method'])(**data['kwargs'])
+                if res:
+                    self.client.respond(**res)
+            data = self.client.receive()
 
     def run(self, circuit_spec, inputs):
-        circuit = GarbledCircuit(circuit_spec)
+        stream = self.chunk_size is not None
+        circuit = self.garble(circuit_spec, stream)
         a_wires = circuit_spec['alice']
         b_wires = circuit_spec['bob']
         active_labels = circuit.encode_labels(inputs, a_wires)
-        self.circuit_input(circuit_spec, circuit.garbled_tables, circuit.out_p_bits, active_labels)
+        active_labels.update(circuit.encode_constants())
+        with metrics.span('circuit_input', engine=self.engine):
+            self.circuit_input(circuit_spec, circuit.garbled_tables, circuit.out_p_bits, active_labels)
         self.b_keys = circuit.keys_of_wires(b_wires)
 
         # share keys by using ot
-        data = self.client.receive()
-        while not is_closed(data):
-            res = getattr(self.switch[data['app']], data['method'])(**data['kwargs'])
-            if res:
-                self.client.socket.send(json.dumps(res).encode('utf-8'))
-            data = self.client.receive()
+        self.dispatch()
 
-        data = self.client.receive()
+        if stream:
+            with metrics.span('circuit_chunks', engine=self.engine):
+                self.circuit_chunks(circuit)
+        with metrics.span('result', engine=self.engine):
+            data = self.client.receive()
         return {int(k): v for k, v in data.items()}
+
+    def run_batch(self, circuit_spec, inputs):
+        """
+            Evaluates a circuit once for each input vector, over one connection.
+            Each instance has its own garbling, taken from the pool when there is one,
+            all the tables travel in one message, Bob's keys of all the instances
+            are transferred with one batch of OTs and the results come back together.
+            Tables are never streamed in a batch.
+            Parameters:
+                circuit_spec: dict
+                    circuit spec shared by the instances
+                inputs: list of Alice's input vectors
+            Returns:
+                results: list of the evaluations, one for each input vector
+        """
+        if not inputs:
+            return []
+        circuits = [self.garble(circuit_spec) for _ in inputs]
+        active_labels = []
+        for circuit, values in zip(circuits, inputs):
+            labels = circuit.encode_labels(values, circuit_spec['alice'])
+            labels.update(circuit.encode_constants())
+            active_labels.append(labels)
+        self.batch_keys = [circuit.keys_of_wires(circuit_spec['bob']) for circuit in circuits]
+
+        self.client.connect()
+        with metrics.span('circuit_batch', engine=self.engine):
+            self.client.send(self.__class__.__name__, 'circuit_batch', circuit=circuit_spec,
+                             tables=[circuit.garbled_tables.dump() for circuit in circuits],
+                             output_p_bits=[circuit.out_p_bits for circuit in circuits], active_labels=active_labels,
+                             free_xor=self.free_xor, engine=self.engine, ot_extension=self.ot_extension is not None)
+        self.dispatch()
+        with metrics.span('result', engine=self.engine):
+            data = self.client.receive()
+        return [{int(k): v for k, v in result.items()} for result in data['results']]
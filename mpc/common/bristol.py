@@ -0,0 +1,66 @@
+import os
+
+# Bristol Fashion gates with a counterpart in the circuit specs
+GATES = {
+    "AND": "AND",
+    "XOR": "XOR",
+    "INV": "NOT",
+    "EQW": "BUF",
+}
+
+
+def load_bristol(path, name=None, alice_values=1):
+    """
+    Parse a Bristol Fashion circuit into a circuit spec, line by line.
+    The wires of the first input values are Alice's, the others Bob's,
+    and the outputs are the last wires of the circuit. EQ gates assign
+    constant wires and MAND gates are split into AND gates.
+        Parameters:
+            path: str
+                path of the Bristol Fashion file
+            name: str
+                name of the circuit, the file name by default
+            alice_values: int
+                number of input values of Alice
+        Returns:
+            circuit: dict
+                circuit spec with "name", "alice", "bob", "const", "out" and "gates"
+    """
+    with open(path) as f:
+        lines = (line.split() for line in f)
+        lines = (tokens for tokens in lines if tokens)
+
+        num_gates, num_wires = (int(token) for token in next(lines))
+        input_sizes = [int(token) for token in next(lines)[1:]]
+        output_sizes = [int(token) for token in next(lines)[1:]]
+
+        gates, constants = [], {}
+        count = 0
+        for tokens in lines:
+            count += 1
+            num_in, num_out, gate_type = int(tokens[0]), int(tokens[1]), tokens[-1]
+            wires = [int(token) for token in tokens[2:2 + num_in + num_out]]
+            gate_in, gate_out = wires[:num_in], wires[num_in:]
+            if gate_type == "EQ":
+                constants[gate_out[0]] = gate_in[0]
+            elif gate_type == "MAND":
+                # the left inputs of all the ANDs, then the right ones
+                for i, out in enumerate(gate_out):
+                    gates.append({"id": out, "type": "AND", "in": [gate_in[i], gate_in[num_out + i]]})
+            elif gate_type in GATES:
+                gates.append({"id": gate_out[0], "type": GATES[gate_type], "in": gate_in})
+            else:
+                raise ValueError("Unsupported Bristol gate {0}".format(gate_type))
+    if count != num_gates:
+        raise ValueError("Expected {0} gates, found {1}".format(num_gates, count))
+
+    num_alice = sum(input_sizes[:alice_values])
+    num_inputs = sum(input_sizes)
+    return {
+        "name": name or os.path.splitext(os.path.basename(path))[0],
+        "alice": list(range(num_alice)),
+        "bob": list(range(num_alice, num_inputs)),
+        "const": constants,
+        "out": list(range(num_wires - sum(output_sizes), num_wires)),
+        "gates": gates,
+    }
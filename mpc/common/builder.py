@@ -0,0 +1,322 @@
+import os
+
+from mpc.common.circuit import CACHE_DIR, CompiledCircuit, cached_circuit, optimize_circuit
+
+# version of the gadgets, part of the names of the cached circuits
+BUILDER_VERSION = 1
+# operand size from which Karatsuba takes fewer AND gates than the schoolbook product
+KARATSUBA_MIN_BITS = 20
+
+
+class CircuitBuilder(object):
+    """
+    Builds a circuit spec gate by gate.
+    Wires are numbered in order of creation and numbers are bit vectors,
+    lists of wires with the least significant bit first.
+
+    Parameters:
+        name: str
+            name of the circuit
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.alice = []  # input wires of Alice
+        self.bob = []  # input wires of Bob
+        self.constants = {}  # bit -> constant wire
+        self.gates = []  # list of gate specs
+        self.num_wires = 0
+
+    def _wire(self):
+        self.num_wires += 1
+        return self.num_wires - 1
+
+    def alice_inputs(self, num_bits):
+        wires = [self._wire() for _ in range(num_bits)]
+        self.alice.extend(wires)
+        return wires
+
+    def bob_inputs(self, num_bits):
+        wires = [self._wire() for _ in range(num_bits)]
+        self.bob.extend(wires)
+        return wires
+
+    def constant(self, bit):
+        if bit not in self.constants:
+            self.constants[bit] = self._wire()
+        return self.constants[bit]
+
+    def gate(self, gate_type, *gate_in):
+        wire = self._wire()
+        self.gates.append({"id": wire, "type": gate_type, "in": list(gate_in)})
+        return wire
+
+    def xor(self, a, b):
+        return self.gate("XOR", a, b)
+
+    def xnor(self, a, b):
+        return self.gate("XNOR", a, b)
+
+    def and_(self, a, b):
+        return self.gate("AND", a, b)
+
+    def not_(self, a):
+        return self.gate("NOT", a)
+
+    def spec(self, out, optimize=True):
+        """
+        Circuit spec computing the given wires.
+            Parameters:
+                out: list of the output wires
+                optimize: bool
+                    if True, the spec goes through `optimize_circuit`, which
+                    folds the constants and drops the gates out does not need
+            Returns:
+                circuit: dict
+        """
+        circuit = {
+            "name": self.name,
+            "alice": list(self.alice),
+            "bob": list(self.bob),
+            "const": {wire: bit for bit, wire in self.constants.items()},
+            "out": list(out),
+            "gates": list(self.gates),
+        }
+        if optimize:
+            circuit, _ = optimize_circuit(circuit)
+        return circuit
+
+
+def ripple_add(builder, x, y, carry=None):
+    """
+    Ripple-carry adder, one AND gate per bit.
+        Parameters:
+            builder: CircuitBuilder
+            x, y: bit vectors, y no longer than x
+            carry: carry in wire, None for 0
+        Returns:
+            sums: bit vector as long as x
+            carry: carry out wire, None for 0
+    """
+    sums = []
+    for i, x_i in enumerate(x):
+        y_i = y[i] if i < len(y) else None
+        if y_i is None and carry is None:
+            sums.append(x_i)
+        elif y_i is None or carry is None:
+            other = carry if y_i is None else y_i
+            sums.append(builder.xor(x_i, other))
+            carry = builder.and_(x_i, other)
+        else:
+            # c' = c ^ ((x ^ c) & (y ^ c)) is the majority of x, y and c
+            x_c = builder.xor(x_i, carry)
+            sums.append(builder.xor(x_c, y_i))
+            carry = builder.xor(carry, builder.and_(x_c, builder.xor(y_i, carry)))
+    return sums, carry
+
+
+def lookahead_add(builder, x, y):
+    """
+    Carry-lookahead adder with a Sklansky parallel prefix, for a depth
+    logarithmic in the number of bits at the cost of more AND gates.
+        Parameters:
+            builder: CircuitBuilder
+            x, y: bit vectors of the same length
+        Returns:
+            sums: bit vector as long as x
+            carry: carry out wire
+    """
+    propagate = [builder.xor(x_i, y_i) for x_i, y_i in zip(x, y)]
+    # generate and propagate of the prefixes, g | (p & g') is g ^ (p & g') since g and p exclude each other
+    g, p = [builder.and_(x_i, y_i) for x_i, y_i in zip(x, y)], list(propagate)
+    span = 1
+    while span < len(x):
+        for i in range(len(x)):
+            if (i // span) % 2:
+                j = (i // span) * span - 1
+                g[i] = builder.xor(g[i], builder.and_(p[i], g[j]))
+                p[i] = builder.and_(p[i], p[j])
+        span *= 2
+    sums = propagate[:1] + [builder.xor(p_i, g_i) for p_i, g_i in zip(propagate[1:], g)]
+    return sums, g[-1]
+
+
+def subtract(builder, x, y):
+    """
+    Subtractor, one AND gate per bit.
+        Parameters:
+            builder: CircuitBuilder
+            x, y: bit vectors, y no longer than x
+        Returns:
+            difference: x - y modulo 2^len(x)
+            borrow: 1 if x < y
+    """
+    difference, borrow = [], None
+    for i, x_i in enumerate(x):
+        y_i = y[i] if i < len(y) else None
+        if y_i is None and borrow is None:
+            difference.append(x_i)
+        elif y_i is None or borrow is None:
+            other = borrow if y_i is None else y_i
+            difference.append(builder.xor(x_i, other))
+            borrow = builder.and_(builder.not_(x_i), other)
+        else:
+            difference.append(builder.xor(builder.xor(x_i, y_i), borrow))
+            borrow = _majority(builder, x_i, y_i, borrow)
+    return difference, borrow
+
+
+def greater_than(builder, x, y):
+    """
+    Unsigned comparison, one AND gate per bit: the borrow of y - x.
+        Parameters:
+            builder: CircuitBuilder
+            x, y: bit vectors of the same length
+        Returns:
+            gt: wire set if x > y
+    """
+    borrow = builder.and_(x[0], builder.not_(y[0]))
+    for x_i, y_i in zip(x[1:], y[1:]):
+        borrow = _majority(builder, y_i, x_i, borrow)
+    return borrow
+
+
+def _majority(builder, x, y, borrow):
+    # borrow of x - y - borrow, the majority of ~x, y and borrow: y ^ ((~x ^ y) & (borrow ^ y))
+    return builder.xor(y, builder.and_(builder.xnor(x, y), builder.xor(borrow, y)))
+
+
+def equal(builder, x, y):
+    """
+    Equality test, len(x) - 1 AND gates in a balanced tree.
+        Returns:
+            eq: wire set if x == y
+    """
+    bits = [builder.xnor(x_i, y_i) for x_i, y_i in zip(x, y)]
+    while len(bits) > 1:
+        bits = [builder.and_(a, b) for a, b in zip(bits[::2], bits[1::2])] + bits[len(bits) - len(bits) % 2:]
+    return bits[0]
+
+
+def mux(builder, s, x, y):
+    """
+    Multiplexer, one AND gate per bit: x ^ (s & (x ^ y)).
+        Returns:
+            z: y if s is set, x otherwise
+    """
+    return [builder.xor(x_i, builder.and_(s, builder.xor(x_i, y_i))) for x_i, y_i in zip(x, y)]
+
+
+def multiply(builder, x, y):
+    """
+    Full product, with Karatsuba from KARATSUBA_MIN_BITS bits.
+        Parameters:
+            builder: CircuitBuilder
+            x, y: bit vectors of the same length n
+        Returns:
+            product: bit vector of 2n bits
+    """
+    n = len(x)
+    if n < KARATSUBA_MIN_BITS:
+        return schoolbook_multiply(builder, x, y)
+    h = n // 2
+    z0 = multiply(builder, x[:h], y[:h])
+    z2 = multiply(builder, x[h:], y[h:])
+    x_sum, x_carry = ripple_add(builder, x[h:], x[:h])
+    y_sum, y_carry = ripple_add(builder, y[h:], y[:h])
+    z1 = multiply(builder, x_sum + [x_carry], y_sum + [y_carry])
+    # z1 - z0 - z2 is the middle term, never negative
+    z1, _ = subtract(builder, z1, z0)
+    z1, _ = subtract(builder, z1, z2)
+    product = z0 + z2
+    high, _ = ripple_add(builder, product[h:], z1[:2 * n - h])
+    return product[:h] + high
+
+
+def schoolbook_multiply(builder, x, y):
+    """
+    Full product as the sum of the partial products, len(x) * len(y) AND gates
+    for the partial products and about as many for the additions.
+        Returns:
+            product: bit vector of len(x) + len(y) bits
+    """
+    product = [builder.and_(x_i, y[0]) for x_i in x]
+    for j in range(1, len(y)):
+        row = [builder.and_(x_i, y[j]) for x_i in x]
+        high, carry = ripple_add(builder, row, product[j:])
+        product = product[:j] + high + [carry if carry is not None else builder.constant(0)]
+    return product + [builder.constant(0)] * (len(x) + len(y) - len(product))
+
+
+def _two_operands(build):
+    def circuit(builder, num_bits):
+        return build(builder, builder.alice_inputs(num_bits), builder.bob_inputs(num_bits))
+    return circuit
+
+
+def _add(builder, x, y):
+    sums, carry = ripple_add(builder, x, y)
+    return sums + [carry]
+
+
+def _lookahead_add(builder, x, y):
+    sums, carry = lookahead_add(builder, x, y)
+    return sums + [carry]
+
+
+def _mux(builder, num_bits):
+    # Alice holds the selector and x, Bob holds y
+    s = builder.alice_inputs(1)[0]
+    x = builder.alice_inputs(num_bits)
+    return mux(builder, s, x, builder.bob_inputs(num_bits))
+
+
+# two-party circuits by name, Alice holds x and Bob holds y
+CIRCUITS = {
+    "add": _two_operands(_add),
+    "add_lookahead": _two_operands(_lookahead_add),
+    "sub": _two_operands(lambda builder, x, y: subtract(builder, x, y)[0]),
+    "gt": _two_operands(lambda builder, x, y: [greater_than(builder, x, y)]),
+    "eq": _two_operands(lambda builder, x, y: [equal(builder, x, y)]),
+    "mul": _two_operands(multiply),
+    "mux": _mux,
+}
+
+
+def build_circuit(name, num_bits):
+    """
+    Build one of the circuits of CIRCUITS.
+        Parameters:
+            name: str
+                name of the circuit
+            num_bits: int
+                size of the operands
+        Returns:
+            circuit: dict
+                circuit spec, with the outputs least significant bit first
+    """
+    if name not in CIRCUITS:
+        raise ValueError("Unknown circuit {0}".format(name))
+    builder = CircuitBuilder("{0} {1}".format(name, num_bits))
+    return builder.spec(CIRCUITS[name](builder, num_bits))
+
+
+def load_builtin(name, num_bits, cache_dir=CACHE_DIR):
+    """
+    Build one of the circuits of CIRCUITS through the cache of compiled circuits,
+    keyed by the name, the size, BUILDER_VERSION and the version of the format.
+        Parameters:
+            name: str
+                name of the circuit
+            num_bits: int
+                size of the operands
+            cache_dir: str
+                directory of the compiled circuits, None to disable the cache
+        Returns:
+            compiled: CompiledCircuit
+    """
+    if cache_dir is None:
+        return CompiledCircuit.compile(build_circuit(name, num_bits))
+    cached = os.path.join(cache_dir, "{0}-{1}-v{2}.{3}.mpcc".format(name, num_bits, BUILDER_VERSION,
+                                                                    CompiledCircuit.VERSION))
+    return cached_circuit(cached, lambda: CompiledCircuit.compile(build_circuit(name, num_bits)))
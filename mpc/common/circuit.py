@@ -0,0 +1,508 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from mpc.common.instrumentation import metrics
+
+# gate types by opcode of a CompiledCircuit
+GATE_TYPES = ("AND", "OR", "XOR", "NAND", "NOR", "XNOR", "NOT", "BUF")
+OPCODES = {gate_type: opcode for opcode, gate_type in enumerate(GATE_TYPES)}
+# default directory of the compiled circuits
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mpc")
+# gates garbled into a table even with Free-XOR
+NON_FREE_GATES = ("AND", "OR", "NAND", "NOR")
+# AND-like gates by the negations of their inputs and output: NOR is ~a & ~b, OR is ~(~a & ~b)
+AND_GATES = {
+    (0, 0, 0): "AND",
+    (0, 0, 1): "NAND",
+    (1, 1, 0): "NOR",
+    (1, 1, 1): "OR",
+}
+NEGATIONS = {gate_type: negations for negations, gate_type in AND_GATES.items()}
+# gate computing the negation of another on the same inputs
+COMPLEMENTS = {"AND": "NAND", "NAND": "AND", "OR": "NOR", "NOR": "OR", "XOR": "XNOR", "XNOR": "XOR",
+               "NOT": "BUF", "BUF": "NOT"}
+
+
+def input_wires(gates):
+    """
+    Retrieve the wires that are not the output of any gate.
+        Parameters:
+            gates: list
+                list of gate specs
+        Returns:
+            wires: set
+                IDs of the input wires of the circuit
+    """
+    outputs = {gate["id"] for gate in gates}
+    return {wire for gate in gates for wire in gate["in"] if wire not in outputs}
+
+
+def fanout(gates):
+    """
+    Count the gates reading each wire.
+        Parameters:
+            gates: list
+                list of gate specs
+        Returns:
+            readers: dict
+                mapping each wire to the number of gates reading it
+    """
+    readers = {gate["id"]: 0 for gate in gates}
+    for gate in gates:
+        for wire in gate["in"]:
+            readers[wire] = readers.get(wire, 0) + 1
+    return readers
+
+
+def levelize(gates):
+    """
+    Sort gates topologically and group them by dependency level.
+    Gates of a level only depend on the circuit inputs and on the gates
+    of the previous levels, so they can be processed as one batch.
+        Parameters:
+            gates: list
+                list of gate specs, in any order
+        Returns:
+            levels: list
+                list of levels, each a list of gate positions in `gates`
+    """
+    producers = {}  # maps each wire to the position of the gate computing it
+    for position, gate in enumerate(gates):
+        if gate["id"] in producers:
+            raise ValueError("Wire {0} is the output of more than one gate".format(gate["id"]))
+        producers[gate["id"]] = position
+
+    depth = [None] * len(gates)  # level of each gate
+    levels = []
+    for position in range(len(gates)):
+        if depth[position] is not None:
+            continue
+        # iterative depth-first visit of the gates the current one depends on
+        stack, visiting = [position], set()
+        while stack:
+            current = stack[-1]
+            if depth[current] is not None:
+                stack.pop()
+                continue
+            visiting.add(current)
+            pending = [producers[wire] for wire in gates[current]["in"]
+                       if wire in producers and depth[producers[wire]] is None]
+            if pending:
+                for dependency in pending:
+                    if dependency in visiting:
+                        raise ValueError("Circuit has a cycle through gate {0}".format(gates[dependency]["id"]))
+                stack.extend(pending)
+                continue
+            stack.pop()
+            visiting.discard(current)
+            level = 1 + max((depth[producers[wire]] for wire in gates[current]["in"] if wire in producers),
+                            default=-1)
+            depth[current] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(current)
+
+    return levels
+
+
+def optimize_circuit(circuit):
+    """
+    Simplify a circuit spec before garbling, keeping its inputs and outputs.
+    Every wire is rewritten as a literal, a wire of the new circuit and whether
+    it is negated, or a constant bit. Constants are folded, NOT gates only flip
+    the literals and are absorbed into the gates reading them (XOR into XNOR,
+    AND-like gates with both inputs negated by De Morgan), identical gates are
+    merged and the gates no output depends on are dropped. The gates removed
+    are counted in the gates_removed and non_free_gates_removed metrics.
+        Parameters:
+            circuit: dict
+                circuit spec
+        Returns:
+            optimized: dict
+                circuit spec computing the same outputs
+            report: dict
+                number of gates and of non-free gates before and after, and
+                number of gates removed, 0 when the NOT gates of mixed
+                negations make the circuit grow
+    """
+    gates = circuit["gates"]
+    literals = {wire: (wire, 0) for wire in circuit["alice"] + circuit["bob"]}
+    literals.update({int(wire): (None, bit) for wire, bit in circuit.get("const", {}).items()})
+
+    new_gates = {}  # id -> gate of the optimized circuit, in topological order
+    merged = {}  # (type, inputs) -> id of the gate computing it
+    next_id = [1 + max([wire for gate in gates for wire in [gate["id"]] + gate["in"]] + list(literals), default=-1)]
+
+    def emit(gate_type, gate_in, gate_id=None):
+        key = (gate_type, tuple(sorted(gate_in)))
+        if key not in merged:
+            if gate_id is None or gate_id in new_gates:
+                gate_id, next_id[0] = next_id[0], next_id[0] + 1
+            new_gates[gate_id] = {"id": gate_id, "type": gate_type, "in": list(gate_in)}
+            merged[key] = gate_id
+        return merged[key], 0
+
+    def positive(literal):
+        # wire holding the value of a literal, with a NOT gate if it is negated
+        wire, negated = literal
+        return emit("NOT", [wire])[0] if negated else wire
+
+    for level in levelize(gates):
+        for position in level:
+            gate = gates[position]
+            gate_type, gate_id = gate["type"], gate["id"]
+            try:
+                inputs = [literals[wire] for wire in gate["in"]]
+            except KeyError as e:
+                raise ValueError("Wire {0} is neither an input nor the output of a gate".format(e.args[0]))
+            a, b = inputs[0], inputs[-1]
+            if gate_type == "NOT":
+                literals[gate_id] = (a[0], a[1] ^ 1)
+            elif gate_type == "BUF":
+                literals[gate_id] = a
+            elif gate_type in ("XOR", "XNOR"):
+                negated = a[1] ^ b[1] ^ (gate_type == "XNOR")
+                if a[0] == b[0]:
+                    # two constants or twice the same wire
+                    literals[gate_id] = (None, negated)
+                elif a[0] is None or b[0] is None:
+                    literals[gate_id] = (a[0] if b[0] is None else b[0], negated)
+                else:
+                    literals[gate_id] = emit("XNOR" if negated else "XOR", [a[0], b[0]], gate_id)
+            elif gate_type in NEGATIONS:
+                in_a, in_b, out = NEGATIONS[gate_type]
+                a, b = (a[0], a[1] ^ in_a), (b[0], b[1] ^ in_b)
+                if a[0] is None or b[0] is None:
+                    # 0 & x is 0 and 1 & x is x
+                    constant, other = (a, b) if a[0] is None else (b, a)
+                    literals[gate_id] = (other[0], other[1] ^ out) if constant[1] else (None, out)
+                elif a[0] == b[0]:
+                    # x & x is x and x & ~x is 0
+                    literals[gate_id] = (a[0], a[1] ^ out) if a[1] == b[1] else (None, out)
+                else:
+                    if a[1] != b[1]:
+                        a, b = (positive(a), 0), (positive(b), 0)
+                    literals[gate_id] = emit(AND_GATES[a[1], b[1], out], [a[0], b[0]], gate_id)
+            else:
+                raise ValueError("Unknown gate type {0}".format(gate_type))
+
+    # gates some output depends on, a wire listed twice in out is computed once
+    out_wires = list(dict.fromkeys(circuit["out"]))
+    outputs = [literals[wire] for wire in out_wires]
+    live = {wire for wire, _ in outputs if wire is not None}
+    for gate_id in reversed(list(new_gates)):
+        if gate_id in live:
+            live.update(new_gates[gate_id]["in"])
+    new_gates = {gate_id: gate for gate_id, gate in new_gates.items() if gate_id in live}
+    readers = {}
+    for gate in new_gates.values():
+        for wire in gate["in"]:
+            readers[wire] = readers.get(wire, 0) + 1
+    for wire, _ in outputs:
+        readers[wire] = readers.get(wire, 0) + 1
+
+    constants, out_gates = {}, []
+    for out, (wire, negated) in zip(out_wires, outputs):
+        if wire is None:
+            constants[out] = negated
+        elif wire == out and not negated:
+            continue
+        elif wire in new_gates and readers[wire] == 1:
+            # the only reader of the gate is the output, the gate computes it in place
+            gate = new_gates.pop(wire)
+            new_gates[out] = dict(gate, id=out, type=COMPLEMENTS[gate["type"]] if negated else gate["type"])
+        else:
+            out_gates.append({"id": out, "type": "NOT" if negated else "BUF", "in": [wire]})
+
+    optimized = {key: value for key, value in circuit.items() if key not in ("wires", "levels", "fanout")}
+    optimized.update({"const": constants, "gates": list(new_gates.values()) + out_gates})
+    before, after = len(gates), len(optimized["gates"])
+    report = {
+        "gates": [before, after],
+        "non_free_gates": [sum(gate["type"] in NON_FREE_GATES for gate in gates),
+                           sum(gate["type"] in NON_FREE_GATES for gate in optimized["gates"])],
+        "removed": max(before - after, 0),
+    }
+    metrics.count("gates_removed", report["removed"])
+    metrics.count("non_free_gates_removed", max(report["non_free_gates"][0] - report["non_free_gates"][1], 0))
+    return optimized, report
+
+
+def chunk_levels(levels, chunk_size):
+    """
+    Split levels into chunks of independent gates, in topological order.
+        Parameters:
+            levels: list
+                levels of gate positions as returned by `levelize`
+            chunk_size: int
+                maximum number of gates of a chunk
+        Yields:
+            positions: list
+                positions of the gates of the chunk
+    """
+    for level in levels:
+        for start in range(0, len(level), chunk_size):
+            yield level[start:start + chunk_size]
+
+
+def circuit_levels(circuit):
+    """
+    Levels of a circuit spec, precomputed when the spec comes from a CompiledCircuit.
+        Parameters:
+            circuit: dict
+                circuit spec
+        Returns:
+            levels: list
+                list of levels, each a sequence of gate positions
+    """
+    if "levels" in circuit:
+        return [range(start, end) for start, end in circuit["levels"]]
+    return levelize(circuit["gates"])
+
+
+def circuit_fanout(circuit):
+    """
+    Fan-out of the wires of a circuit spec, precomputed when the spec comes from a CompiledCircuit.
+        Parameters:
+            circuit: dict
+                circuit spec
+        Returns:
+            readers: dict or list
+                number of gates reading each wire, indexed by wire
+    """
+    if "fanout" in circuit:
+        return list(circuit["fanout"])
+    return fanout(circuit["gates"])
+
+
+class CompiledCircuit(object):
+    """
+    Compact binary form of a circuit spec.
+    Wires are renumbered densely: Alice's inputs, then Bob's, then the
+    constant wires and the outputs of the gates in topological order, so
+    that gate i computes wire num_inputs + i and the levels are ranges of
+    consecutive gates.
+
+    Parameters:
+        name: str
+            name of the circuit
+        num_alice: int
+            number of input wires of Alice
+        num_bob: int
+            number of input wires of Bob
+        constants: array
+            bit of each constant wire
+        out: array
+            dense ids of the output wires
+        opcodes: array
+            opcode of each gate, see GATE_TYPES
+        inputs: array
+            dense ids of the two inputs of each gate, -1 for unary gates
+        bounds: array
+            end position of each level
+        readers: array
+            number of gates reading each wire
+        wire_ids: array
+            original id of each wire
+    """
+
+    MAGIC = b"MPCC"
+    # magic, version, num_alice, num_bob, num_const, num_out, num_gates, num_levels, length of the name
+    HEADER = struct.Struct("<4sI7q")
+    VERSION = 2
+
+    def __init__(self, name, num_alice, num_bob, constants, out, opcodes, inputs, bounds, readers, wire_ids):
+        self.name = name
+        self.num_alice = num_alice
+        self.num_bob = num_bob
+        self.constants = constants
+        self.out = out
+        self.opcodes = opcodes
+        self.inputs = inputs
+        self.bounds = bounds
+        self.readers = readers
+        self.wire_ids = wire_ids
+
+    @property
+    def num_inputs(self):
+        return self.num_alice + self.num_bob + len(self.constants)
+
+    @classmethod
+    def compile(cls, circuit):
+        """
+        Compile a circuit spec.
+            Parameters:
+                circuit: dict
+                    circuit spec with "name", "alice", "bob", "out", "gates" and optionally "const"
+            Returns:
+                compiled: CompiledCircuit
+        """
+        gates = circuit["gates"]
+        levels = levelize(gates)
+        constants = {int(wire): bit for wire, bit in circuit.get("const", {}).items()}
+        wire_ids = array("q", circuit["alice"] + circuit["bob"] + list(constants))
+        dense = {wire: index for index, wire in enumerate(wire_ids)}
+        for level in levels:
+            for position in level:
+                dense[gates[position]["id"]] = len(wire_ids)
+                wire_ids.append(gates[position]["id"])
+
+        opcodes, inputs, bounds = array("B"), array("i"), array("i")
+        for level in levels:
+            for position in level:
+                gate = gates[position]
+                if gate["type"] not in OPCODES:
+                    raise ValueError("Unknown gate type {0}".format(gate["type"]))
+                opcodes.append(OPCODES[gate["type"]])
+                try:
+                    inputs.extend([dense[wire] for wire in gate["in"]] + [-1] * (2 - len(gate["in"])))
+                except KeyError as e:
+                    raise ValueError("Wire {0} is neither an input nor the output of a gate".format(e.args[0]))
+            bounds.append(len(opcodes))
+
+        readers = array("i", [0]) * len(wire_ids)
+        for wire in inputs:
+            if wire >= 0:
+                readers[wire] += 1
+        out = array("i", [dense[wire] for wire in circuit["out"]])
+        return cls(circuit["name"], len(circuit["alice"]), len(circuit["bob"]), array("B", constants.values()), out,
+                   opcodes, inputs, bounds, readers, wire_ids)
+
+    def spec(self):
+        """
+        Circuit spec of the compiled circuit, with dense wire ids.
+        It also carries the number of wires, the levels and the fan-out,
+        so they are not computed again by the garbler and the evaluator.
+            Returns:
+                circuit: dict
+        """
+        inputs, base = self.inputs, self.num_inputs
+        gates = [{"id": base + i, "type": GATE_TYPES[opcode],
+                  "in": [inputs[2 * i]] if inputs[2 * i + 1] < 0 else [inputs[2 * i], inputs[2 * i + 1]]}
+                 for i, opcode in enumerate(self.opcodes)]
+        num_parties = self.num_alice + self.num_bob
+        return {
+            "name": self.name,
+            "alice": list(range(self.num_alice)),
+            "bob": list(range(self.num_alice, num_parties)),
+            "const": {num_parties + i: bit for i, bit in enumerate(self.constants)},
+            "out": list(self.out),
+            "gates": gates,
+            "wires": len(self.wire_ids),
+            "levels": [[start, end] for start, end in zip([0] + list(self.bounds[:-1]), self.bounds)],
+            "fanout": list(self.readers),
+        }
+
+    def original_wires(self, values):
+        """
+        Map results keyed by dense wire ids back to the wire ids of the original spec.
+        """
+        return {self.wire_ids[wire]: value for wire, value in values.items()}
+
+    def dump(self, path):
+        """
+        Write the compiled circuit, arrays are stored little-endian.
+        """
+        name = self.name.encode("utf-8")
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.num_alice, self.num_bob, len(self.constants),
+                                  len(self.out), len(self.opcodes), len(self.bounds), len(name))
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(name.ljust(-(-len(name) // 8) * 8, b"\0"))
+            # 8 bytes items first, so that every array is aligned
+            for values in (self.wire_ids, self.out, self.inputs, self.bounds, self.readers, self.constants,
+                           self.opcodes):
+                if sys.byteorder == "big":
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                f.write(values.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map a compiled circuit in memory, the arrays are views of the file.
+        """
+        with open(path, "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, version, num_alice, num_bob, num_const, num_out, num_gates, num_levels, name_length = \
+            cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("{0} is not a compiled circuit".format(path))
+        offset = cls.HEADER.size + -(-name_length // 8) * 8
+        name = bytes(data[cls.HEADER.size:cls.HEADER.size + name_length]).decode("utf-8")
+
+        num_wires = num_alice + num_bob + num_const + num_gates
+        arrays = []
+        for typecode, length in (("q", num_wires), ("i", num_out), ("i", 2 * num_gates), ("i", num_levels),
+                                 ("i", num_wires), ("B", num_const), ("B", num_gates)):
+            size = length * array(typecode).itemsize
+            view = data[offset:offset + size]
+            if sys.byteorder == "big":
+                view = array(typecode, view)
+                view.byteswap()
+            else:
+                view = view.cast(typecode)
+            arrays.append(view)
+            offset += size
+        wire_ids, out, inputs, bounds, readers, constants, opcodes = arrays
+        return cls(name, num_alice, num_bob, constants, out, opcodes, inputs, bounds, readers, wire_ids)
+
+
+def load_circuit(path, cache_dir=CACHE_DIR, optimize=False):
+    """
+    Load a JSON circuit spec through the cache of compiled circuits.
+    The cache is keyed by the hash of the file and the version of the
+    format, so a cached circuit is mapped in memory without parsing the
+    JSON at all.
+        Parameters:
+            path: str
+                path of the JSON circuit spec
+            cache_dir: str
+                directory of the compiled circuits, None to disable the cache
+            optimize: bool
+                if True, the circuit is simplified by `optimize_circuit`
+                before being compiled, and cached apart
+        Returns:
+            compiled: CompiledCircuit
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    if cache_dir is None:
+        return _compile(content, optimize)
+
+    digest = hashlib.sha256(content).hexdigest()
+    name = "{0}{1}-v{2}.mpcc".format(digest, ".opt" if optimize else "", CompiledCircuit.VERSION)
+    cached = os.path.join(cache_dir, name)
+    return cached_circuit(cached, lambda: _compile(content, optimize))
+
+
+def cached_circuit(path, compile_circuit):
+    """
+    Map a compiled circuit from the cache, compiling it first if it is missing.
+        Parameters:
+            path: str
+                path of the compiled circuit in the cache
+            compile_circuit: callable
+                returns the CompiledCircuit to cache
+        Returns:
+            compiled: CompiledCircuit
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, so that a concurrent reader never sees a partial file
+        partial = "{0}.{1}".format(path, os.getpid())
+        compile_circuit().dump(partial)
+        os.replace(partial, path)
+    return CompiledCircuit.load(path)
+
+
+def _compile(content, optimize):
+    circuit = json.loads(content)
+    if optimize:
+        circuit, _ = optimize_circuit(circuit)
+    return CompiledCircuit.compile(circuit)
@@ -1,24 +1,305 @@
+import asyncio
 import json
+import queue
+import struct
 
+from mpc.common.instrumentation import metrics
 
-def unmarshall_request(data: bytes):
-    buffer = data.decode('utf-8')
-    kwargs = json.loads(buffer)
-    return kwargs['app'], kwargs['method'], kwargs['kwargs']
+# message types
+REQUEST = 1
+RESPONSE = 2
+END = 3  # end of a session of a multiplexed connection, the object is null
+MESSAGE_TYPES = (REQUEST, RESPONSE, END)
 
+# frame header: payload length, message type, session id, request id, length of the json envelope,
+# length of the inline bytes. The payload is the json envelope, the small bytes values it refers to,
+# then the large ones. Session 0 is the session of a connection that is not multiplexed.
+HEADER = struct.Struct('!IBIIII')
+# initial size of the receive buffers
+BUFFER_SIZE = 1 << 16
+# json placeholder of a small bytes value: {"__bytes__": [offset, length]} in the inline bytes
+BYTES_KEY = '__bytes__'
+# json placeholder of a large bytes value: {"__buffer__": [index, length]} among the large values
+BUFFER_KEY = '__buffer__'
+# bytes values from this size are sent from their own buffer and received in place
+LARGE_BYTES = 1 << 12
+# maximum number of buffers of a sendmsg call
+IOV_MAX = 1024
+# maximum size of the payload of a frame received
+MAX_FRAME_BYTES = 1 << 30
 
-def unmarshall_response(data: bytes):
-    buffer = data.decode('utf-8')
-    kwargs = json.loads(buffer)
-    return kwargs
 
+class FrameError(ConnectionAbortedError):
+    # frame breaking the format, the connection is dropped
+    pass
 
-def marshall_request(app, method, **kwargs):
+
+def encode_message(message_type, obj, session_id=0, request_id=0):
+    """
+    Encode a message into the buffers of a frame, without copying large bytes values.
+        Parameters:
+            message_type: REQUEST, RESPONSE or END
+            obj: json serializable object, bytes values are sent as raw bytes
+            session_id: session of the message on a multiplexed connection
+            request_id: id of the request, echoed by its response
+        Returns:
+            frame: list of buffers, the header, the envelope, the inline bytes
+                and the large bytes values, to be sent with send_message
+    """
+    inline, large = [], []
+    size = [0]
+
+    def attach(value):
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            raise TypeError("Object of type {0} is not serializable".format(type(value).__name__))
+        view = memoryview(value).cast('B')
+        if view.nbytes >= LARGE_BYTES:
+            large.append(view)
+            return {BUFFER_KEY: [len(large) - 1, view.nbytes]}
+        inline.append(value)
+        offset, size[0] = size[0], size[0] + view.nbytes
+        return {BYTES_KEY: [offset, view.nbytes]}
+
+    with metrics.span('encode'):
+        envelope = json.dumps(obj, default=attach).encode('utf-8')
+        inline = b''.join(inline)
+        length = len(envelope) + len(inline) + sum(view.nbytes for view in large)
+        header = HEADER.pack(length, message_type, session_id, request_id, len(envelope), len(inline))
+    metrics.count('messages', direction='out')
+    metrics.count('bytes', HEADER.size + length, direction='out')
+    return [header, envelope, inline] + large
+
+
+def send_message(sock, frame):
+    """
+    Send the buffers of a frame, with scatter-gather I/O when the socket supports it.
+        Parameters:
+            sock: the socket
+            frame: list of buffers as returned by encode_message
+    """
+    if isinstance(sock, SessionChannel):
+        # frames of the sessions of a connection are written whole, one at a time
+        sock.send_frame(frame)
+        return
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        sock.sendall(b''.join(frame))
+        return
+    views = [memoryview(buffer).cast('B') for buffer in frame if len(buffer)]
+    while views:
+        sent = sendmsg(views[:IOV_MAX])
+        # drops the buffers sent, and the sent part of the next one
+        while views and sent >= views[0].nbytes:
+            sent -= views.pop(0).nbytes
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def frame_size(frame):
+    return sum(memoryview(buffer).nbytes for buffer in frame)
+
+
+def decode_message(head, envelope_length, large_length=0):
+    """
+    Decode the envelope and the inline bytes of a frame.
+        Parameters:
+            head: the envelope followed by the inline bytes
+            envelope_length: length of the json envelope
+            large_length: length of the rest of the payload, that the
+                large bytes values have to fill exactly
+        Returns:
+            obj: the decoded object
+            buffers: the bytearrays of the large bytes values of obj, in
+                order, still to be filled with the rest of the payload
+    """
+    inline = head[envelope_length:]
+    buffers = []
+    remaining = [large_length]
+
+    def detach(obj):
+        if len(obj) == 1 and BYTES_KEY in obj:
+            offset, length = obj[BYTES_KEY]
+            if not 0 <= offset <= offset + length <= len(inline):
+                raise FrameError("Bytes value out of the frame")
+            return bytes(inline[offset:offset + length])
+        if len(obj) == 1 and BUFFER_KEY in obj:
+            length = obj[BUFFER_KEY][1]
+            if not 0 <= length <= remaining[0]:
+                raise FrameError("Bytes value out of the frame")
+            remaining[0] -= length
+            buffers.append(bytearray(length))
+            return buffers[-1]
+        return obj
+
+    with metrics.span('decode'):
+        try:
+            obj = json.loads(bytes(head[:envelope_length]).decode('utf-8'), object_hook=detach)
+        except ValueError:
+            raise FrameError("Invalid envelope")
+    if remaining[0]:
+        raise FrameError("Frame longer than its bytes values")
+    return obj, buffers
+
+
+def receive_message(sock, buffer):
+    """
+    Receive one frame from a socket.
+    Reads exactly one frame, so several readers may share the socket.
+    Large bytes values are received straight into their own bytearray.
+        Parameters:
+            sock: the socket
+            buffer: bytearray reused across calls, grown when needed
+        Returns:
+            message_type: type of the message
+            obj: the decoded object
+    """
+    message_type, _, _, obj = receive_envelope(sock, buffer)
+    return message_type, obj
+
+
+def receive_envelope(sock, buffer):
+    """
+    Receive one frame from a socket, with the ids of its envelope.
+        Returns:
+            message_type: type of the message
+            session_id: session of the message
+            request_id: id of the request, or of the request answered
+            obj: the decoded object, None for END
+    """
+    if len(buffer) < HEADER.size:
+        buffer.extend(bytes(HEADER.size - len(buffer)))
+    _receive_into(sock, memoryview(buffer)[:HEADER.size])
+    length, message_type, session_id, request_id, envelope_length, inline_length = HEADER.unpack_from(buffer)
+    _check_header(length, message_type, envelope_length, inline_length)
+    head_length = envelope_length + inline_length
+    if len(buffer) < head_length:
+        buffer.extend(bytes(head_length - len(buffer)))
+    head = memoryview(buffer)[:head_length]
+    _receive_into(sock, head)
+    obj, buffers = decode_message(head, envelope_length, length - head_length)
+    for target in buffers:
+        _receive_into(sock, memoryview(target))
+    metrics.count('messages', direction='in')
+    metrics.count('bytes', HEADER.size + length, direction='in')
+    return message_type, session_id, request_id, obj
+
+
+def receive_frame(sock):
+    """
+    Receive one frame from a socket without decoding it, to route it to its session.
+        Returns:
+            message_type: type of the message
+            session_id: session of the message
+            frame: list of buffers, the header and the payload
+    """
+    header = bytearray(HEADER.size)
+    _receive_into(sock, memoryview(header))
+    length, message_type, session_id, _, envelope_length, inline_length = HEADER.unpack_from(header)
+    _check_header(length, message_type, envelope_length, inline_length)
+    payload = bytearray(length)
+    _receive_into(sock, memoryview(payload))
+    return message_type, session_id, [header, payload]
+
+
+async def read_frame(reader):
+    """
+    Receive one frame from an asyncio stream without decoding it.
+        Returns:
+            message_type: type of the message
+            session_id: session of the message
+            frame: list of buffers, the header and the payload
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        length, message_type, session_id, _, envelope_length, inline_length = HEADER.unpack(header)
+        _check_header(length, message_type, envelope_length, inline_length)
+        return message_type, session_id, [header, await reader.readexactly(length)]
+    except asyncio.IncompleteReadError:
+        raise ConnectionAbortedError
+
+
+def _check_header(length, message_type, envelope_length, inline_length):
+    if message_type not in MESSAGE_TYPES:
+        raise FrameError("Unknown message type {0}".format(message_type))
+    if length > MAX_FRAME_BYTES:
+        raise FrameError("Frame of {0} bytes over the limit of {1}".format(length, MAX_FRAME_BYTES))
+    if envelope_length + inline_length > length:
+        raise FrameError("Envelope longer than the frame")
+
+
+def _receive_into(sock, view):
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionAbortedError
+        received += n
+
+
+def unmarshall_request(data):
+    return data['app'], data['method'], data['kwargs']
+
+
+def unmarshall_response(data):
+    return data
+
+
+def marshall_request(app, method, session_id=0, request_id=0, **kwargs):
     req = {'app': app, 'method': method, 'kwargs': kwargs}
-    arguments = json.dumps(req)
-    return arguments.encode('utf-8')
+    return encode_message(REQUEST, req, session_id, request_id)
+
+
+def marshall_response(session_id=0, request_id=0, **kwargs):
+    return encode_message(RESPONSE, kwargs, session_id, request_id)
+
+
+def marshall_end(session_id):
+    return encode_message(END, None, session_id)
+
+
+class SessionChannel(object):
+    """
+        Socket interface of one session of a multiplexed connection.
+        The reader of the connection routes the frames of the session to
+        the channel, where recv_into reads them in order, and frames are
+        written whole by the write callable of the connection.
+        Parameters:
+            write: callable writing the buffers of a frame on the connection
+            on_close: callable run when the session is closed
+            read: callable routing the next frame of the connection, called
+                by recv_into when the connection has no reader thread
+    """
+
+    def __init__(self, write, on_close=None, read=None):
+        self.write = write
+        self.on_close = on_close
+        self.read = read
+        self.closed = False  # set once the session is closed on this side
+        self.frames = queue.Queue()  # frames routed to the session, None once the connection is closed
+        self.pending = []  # buffers of the current frame not read yet
+
+    def put(self, frame):
+        self.frames.put(frame)
+
+    def recv_into(self, view):
+        while not self.pending:
+            while self.read and self.frames.empty():
+                self.read()
+            frame = self.frames.get()
+            if frame is None:
+                return 0
+            self.pending = [memoryview(buffer) for buffer in frame if len(buffer)]
+        n = min(len(view), len(self.pending[0]))
+        view[:n] = self.pending[0][:n]
+        self.pending[0] = self.pending[0][n:]
+        if not self.pending[0]:
+            self.pending.pop(0)
+        return n
 
+    def send_frame(self, frame):
+        self.write(frame)
 
-def marshall_response(**kwargs):
-    arguments = json.dumps(kwargs)
-    return arguments.encode('utf-8')
+    def close(self):
+        self.closed = True
+        if self.on_close:
+            self.on_close()
@@ -1,13 +1,66 @@
 import hashlib
+import json
 import operator
-import random
+import os
+import queue
 import secrets
+import threading
 
 import sympy
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 # order of magnitude of prime in base 2
 PRIME_BITS = 64
 
+# size of a wire label in bytes
+LABEL_BYTES = 16
+LABEL_MASK = (1 << 8 * LABEL_BYTES) - 1
+# public key of the fixed-key AES permutation
+FIXED_AES_KEY = hashlib.sha256(b"mpc fixed-key AES").digest()[:LABEL_BYTES]
+
+# RFC 3526 MODP safe-prime groups, all with generator 2
+MODP_GENERATOR = 2
+MODP_PRIMES = {
+    'modp-1536': int(
+        'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74'
+        '020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437'
+        '4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+        'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05'
+        '98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB'
+        '9ED529077096966D670C354E4ABC9804F1746C08CA237327FFFFFFFFFFFFFFFF', 16),
+    'modp-2048': int(
+        'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74'
+        '020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437'
+        '4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+        'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05'
+        '98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB'
+        '9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+        'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718'
+        '3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF', 16),
+    'modp-3072': int(
+        'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74'
+        '020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437'
+        '4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+        'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05'
+        '98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB'
+        '9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+        'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718'
+        '3995497CEA956AE515D2261898FA051015728E5A8AAAC42DAD33170D04507A33'
+        'A85521ABDF1CBA64ECFB850458DBEF0A8AEA71575D060C7DB3970F85A6E1E4C7'
+        'ABF5AE8CDB0933D71E8C94E04A25619DCEE3D2261AD2EE6BF12FFA06D98A0864'
+        'D87602733EC86A64521F2B18177B200CBBE117577A615D6C770988C0BAD946E2'
+        '08E24FA074E5AB3143DB5BFCE0FD108E4B82D120A93AD2CAFFFFFFFFFFFFFFFF', 16),
+}
+# name of the group of the OTs, about 112 bits of security
+DEFAULT_GROUP = 'modp-2048'
+# name of the groups with a freshly generated PRIME_BITS prime
+RANDOM_GROUP = 'random'
+# size of the secret exponents in the standard groups, twice the security level
+EXPONENT_BITS = 256
+# bits of the exponent consumed by each table lookup of a fixed-base exponentiation
+FIXED_BASE_WINDOW = 6
+
 
 def next_prime(num):
     # next prime after num (skip 2)
@@ -31,15 +84,52 @@ def ot_hash(pub_key, msg_length):  # hash function for OT keys
     return hashlib.shake_256(bytes).digest(msg_length)
 
 
+def gf_double(num):
+    # multiplication by 2 in GF(2^128)
+    num <<= 1
+    if num > LABEL_MASK:
+        num = (num & LABEL_MASK) ^ 0x87
+    return num
+
+
+class FixedKeyAES(object):
+    # hash H(x, i) = pi(K) xor K with K = 2x xor i,
+    # where pi is AES under a fixed public key
+
+    def __init__(self, key=FIXED_AES_KEY):
+        cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+        self.encryptor = cipher.encryptor()
+
+    def __call__(self, labels, tweaks):
+        # hashes all labels (as integers) with a single AES call
+        blocks = [gf_double(label) ^ tweak for label, tweak in zip(labels, tweaks)]
+        data = self.encryptor.update(b"".join(block.to_bytes(LABEL_BYTES, "big") for block in blocks))
+        return [int.from_bytes(data[i:i + LABEL_BYTES], "big") ^ block
+                for i, block in zip(range(0, len(data), LABEL_BYTES), blocks)]
+
+
 class PrimeGroup(object):
     # CryptographicOracle
 
-    def __init__(self, prime=None):
+    def __init__(self, prime=None, generator=None, exponent_bits=None):
         # PRIME_BITS is the number of bits or k
         self.prime = prime or gen_prime(num_bits=PRIME_BITS)
         self.primeM1 = self.prime - 1
         self.primeM2 = self.prime - 2
-        self.generator = self.find_generator()
+        # short exponents are enough, and much faster, in the large standard groups
+        self.exponent_bits = exponent_bits
+        self.generator = generator or self.find_generator()
+        self.generator_base = None  # FixedBase of the generator, see precompute
+
+    def params(self):
+        # public parameters of the group, see GroupProvider.from_params
+        return {'prime': self.prime, 'generator': self.generator, 'exponent_bits': self.exponent_bits}
+
+    def __getstate__(self):
+        # the tables are rebuilt on demand rather than sent along
+        state = self.__dict__.copy()
+        state['generator_base'] = None
+        return state
 
     def mul(self, num1, num2):  # multiplication
         return (num1 * num2) % self.prime
@@ -48,13 +138,29 @@ class PrimeGroup(object):
         return pow(base, exponent, self.prime)
 
     def gen_pow(self, exponent):  # generator exponentiation
+        if self.generator_base:
+            return self.generator_base(exponent)
         return pow(self.generator, exponent, self.prime)
 
+    def precompute(self, window=FIXED_BASE_WINDOW):
+        # tables of the generator for the many gen_pow of the batched OTs
+        if not self.generator_base:
+            self.generator_base = self.fixed_base(self.generator, window)
+
+    def fixed_base(self, base, window=FIXED_BASE_WINDOW):
+        # exponentiation of a base reused across many exponents
+        return FixedBase(base, self.prime, self.exponent_bits or self.prime.bit_length(), window)
+
     def inv(self, num):  # multiplicative inverse
-        return pow(num, self.primeM2, self.prime)
+        try:
+            return pow(num, -1, self.prime)
+        except ValueError:  # python < 3.8
+            return pow(num, self.primeM2, self.prime)
 
-    def rand_int(self):  # random int in [1, prime-1]
-        return random.randint(1, self.primeM1)
+    def rand_int(self):  # random int in [1, prime-1], or in [1, 2^exponent_bits-1]
+        if self.exponent_bits:
+            return 1 + secrets.randbelow((1 << self.exponent_bits) - 1)
+        return 1 + secrets.randbelow(self.primeM1)
 
     def find_generator(self):
         # find random generator for group
@@ -66,3 +172,153 @@ class PrimeGroup(object):
                 if 1 == self.pow(candidate, self.primeM1 // factor): break
             else:
                 return candidate
+
+
+class FixedBase(object):
+    """
+        Windowed fixed-base exponentiation.
+        The powers base^(d * 2^(window * i)) are computed once, so that an
+        exponentiation only costs one multiplication per window of the
+        exponent instead of a squaring per bit.
+    """
+
+    def __init__(self, base, prime, exponent_bits, window=FIXED_BASE_WINDOW):
+        self.base = base
+        self.prime = prime
+        self.window = window
+        self.mask = (1 << window) - 1
+        digits = (exponent_bits + window - 1) // window
+        self.limit = 1 << (digits * window)  # larger exponents fall back to pow
+        self.table = []
+        for _ in range(digits):
+            row = [1]
+            for _ in range(self.mask):
+                row.append(row[-1] * base % prime)
+            self.table.append(row)
+            base = row[-1] * base % prime
+
+    def __call__(self, exponent):
+        if not 0 <= exponent < self.limit:
+            return pow(self.base, exponent, self.prime)
+        result = 1
+        for row in self.table:
+            if not exponent:
+                break
+            digit = exponent & self.mask
+            if digit:
+                result = result * row[digit] % self.prime
+            exponent >>= self.window
+        return result
+
+
+class GroupProvider(object):
+    """
+        Provides the PrimeGroup parameters of the oblivious transfers.
+        The standard MODP groups are built once and shared. Random groups are
+        taken from a pool refilled by a background thread, and the groups
+        left in the pool are saved to an on-disk cache to be reused later.
+    """
+
+    def __init__(self, cache_path=None, pool_size=0):
+        self.cache_path = None
+        self.pool_size = 0
+        self.groups = {}  # standard groups by name
+        self.pool = queue.Queue()  # pre-generated random groups
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()  # set when the pool has to be refilled
+        self.closed = False
+        self.worker = None
+        self.configure(cache_path, pool_size)
+
+    def configure(self, cache_path=None, pool_size=0):
+        """
+            Set the on-disk cache and the size of the pool of random groups,
+            the groups of the cache are added to the pool.
+            Parameters:
+                cache_path: str
+                    path of the cache of random groups, None for no cache
+                pool_size: int
+                    number of random groups generated in advance, 0 for none
+        """
+        self.cache_path = cache_path
+        self.pool_size = pool_size
+        for prime, generator in self._load():
+            self.pool.put(PrimeGroup(prime, generator))
+        if pool_size and self.worker is None:
+            self.worker = threading.Thread(target=self._fill, daemon=True)
+            self.worker.start()
+        self.wanted.set()
+
+    def get(self, name=DEFAULT_GROUP):
+        """
+            Retrieve a group by name.
+            Parameters:
+                name: one of MODP_PRIMES or RANDOM_GROUP
+            Returns:
+                group: a PrimeGroup
+        """
+        if name == RANDOM_GROUP:
+            try:
+                group = self.pool.get_nowait()
+            except queue.Empty:
+                group = PrimeGroup()
+            self.wanted.set()
+            return group
+        if name not in MODP_PRIMES:
+            raise ValueError("Unknown group {0}".format(name))
+        with self.lock:
+            if name not in self.groups:
+                group = PrimeGroup(MODP_PRIMES[name], MODP_GENERATOR, EXPONENT_BITS)
+                group.precompute()
+                self.groups[name] = group
+            return self.groups[name]
+
+    def from_params(self, params):
+        """
+            Group of the parameters received from the other party.
+            Standard groups are shared, with their precomputed tables.
+            Parameters:
+                params: dict as returned by PrimeGroup.params
+            Returns:
+                group: a PrimeGroup
+        """
+        for name, prime in MODP_PRIMES.items():
+            if params['prime'] == prime and params['generator'] == MODP_GENERATOR:
+                return self.get(name)
+        return PrimeGroup(params['prime'], params['generator'], params['exponent_bits'])
+
+    def close(self):
+        # stops the pre-generation and saves the unused random groups
+        self.closed = True
+        self.wanted.set()
+        if self.worker:
+            self.worker.join()
+        groups = []
+        while not self.pool.empty():
+            group = self.pool.get_nowait()
+            groups.append([group.prime, group.generator])
+        self._save(groups)
+
+    def _fill(self):
+        while not self.closed:
+            if self.pool.qsize() >= self.pool_size:
+                self.wanted.wait()
+                self.wanted.clear()
+                continue
+            self.pool.put(PrimeGroup())
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return []
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def _save(self, groups):
+        if not self.cache_path:
+            return
+        with open(self.cache_path, 'w') as f:
+            json.dump(groups, f)
+
+
+# groups of the oblivious transfers, configured at start up by the server
+GROUPS = GroupProvider()
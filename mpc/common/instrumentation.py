@@ -0,0 +1,160 @@
+import json
+import os
+import sys
+import threading
+import time
+
+
+class _Span(object):
+    # times the block it wraps
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.record(self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+
+class _NoSpan(object):
+    # shared span of the disabled instrumentation
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class Metrics(object):
+    """
+        Timings of the phases of the protocols and counts of messages,
+        bytes and OTs, aggregated by name and labels.
+        Every event is also handed to the exporters, callables receiving
+        a dict. When disabled, spans and counts do nothing.
+        Parameters:
+            enabled: bool
+                whether events are recorded
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.exporters = []
+        self.spans = {}  # (name, labels) -> [count, total seconds, max seconds]
+        self.counters = {}  # (name, labels) -> total
+        self.lock = threading.Lock()
+
+    def enable(self, *exporters):
+        self.exporters.extend(exporters)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def span(self, name, **labels):
+        """
+            Context manager timing a phase.
+            Parameters:
+                name: name of the phase
+                labels: labels of the phase, e.g. the protocol and method
+        """
+        if not self.enabled:
+            return NO_SPAN
+        return _Span(self, name, labels)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._export({'type': 'counter', 'name': name, 'value': value, 'labels': labels})
+
+    def record(self, name, seconds, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            stats = self.spans.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        self._export({'type': 'span', 'name': name, 'seconds': seconds, 'labels': labels})
+
+    def snapshot(self):
+        """
+            Returns:
+                metrics: dict with the aggregated spans and counters
+        """
+        with self.lock:
+            spans = [{'name': name, 'labels': dict(labels), 'count': count, 'seconds': total, 'max_seconds': peak}
+                     for (name, labels), (count, total, peak) in self.spans.items()]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in self.counters.items()]
+        return {'spans': spans, 'counters': counters}
+
+    def prometheus(self, prefix='mpc'):
+        """
+            Aggregated metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = ['# TYPE {0}_span_seconds summary'.format(prefix)]
+        for span in snapshot['spans']:
+            labels = _prometheus_labels(dict(span['labels'], span=span['name']))
+            lines.append('{0}_span_seconds_count{1} {2}'.format(prefix, labels, span['count']))
+            lines.append('{0}_span_seconds_sum{1} {2}'.format(prefix, labels, span['seconds']))
+        for name in sorted({counter['name'] for counter in snapshot['counters']}):
+            lines.append('# TYPE {0}_{1}_total counter'.format(prefix, name))
+            for counter in snapshot['counters']:
+                if counter['name'] == name:
+                    labels = _prometheus_labels(counter['labels'])
+                    lines.append('{0}_{1}_total{2} {3}'.format(prefix, name, labels, counter['value']))
+        return '\n'.join(lines) + '\n'
+
+    def _export(self, event):
+        for exporter in self.exporters:
+            exporter(event)
+
+
+class JsonLogExporter(object):
+    """
+        Exporter writing every event as a line of JSON.
+        Parameters:
+            stream: file-like object, stderr by default
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(dict(event, time=time.time()), default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    values = ('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for k, v in sorted(labels.items()))
+    return '{' + ','.join(values) + '}'
+
+
+# instrumentation of the process, enabled at start up with MPC_METRICS=1
+metrics = Metrics(enabled=os.environ.get('MPC_METRICS') == '1')
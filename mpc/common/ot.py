@@ -0,0 +1,94 @@
+import hashlib
+
+from mpc.common.crypto import ot_hash, xor_bytes
+
+# number of base OTs of the OT extension, i.e. the security parameter
+SECURITY_BITS = 128
+# size of the seeds exchanged with the base OTs
+SEED_BYTES = 16
+# size of the batches from which the tables of the fixed bases pay off
+FIXED_BASE_BATCH = 16
+
+
+def choose_key(group, c, b):
+    """
+    Receiver step of the Bellare-Micali OT.
+        Parameters:
+            group: PrimeGroup of the sender
+            c: random group element of the sender
+            b: the choice bit
+        Returns:
+            x: the secret exponent of the receiver
+            h: the public key sent to the sender
+    """
+    x = group.rand_int()
+    h_b = group.gen_pow(x)
+    h_not_b = group.mul(c, group.inv(h_b))
+    return x, h_not_b if b else h_b
+
+
+def encrypt_messages(group, c, h, messages, c_pow=None):
+    """
+    Sender step of the Bellare-Micali OT.
+        Parameters:
+            group: PrimeGroup of the sender
+            c: random group element of the sender
+            h: the public key of the receiver
+            messages: the pair of messages
+            c_pow: optional FixedBase of c, for batches sharing c
+        Returns:
+            c1: the ephemeral key of the sender
+            e0, e1: the encrypted messages
+    """
+    k = group.rand_int()
+    c1 = group.gen_pow(k)
+    h0_k = group.pow(h, k)
+    # (c / h)^k = c^k / h^k, one exponentiation less when c^k comes from a table
+    h1_k = group.mul(c_pow(k) if c_pow else group.pow(c, k), group.inv(h0_k))
+    e0 = xor_bytes(messages[0], ot_hash(h0_k, len(messages[0])))
+    e1 = xor_bytes(messages[1], ot_hash(h1_k, len(messages[1])))
+    return c1, e0, e1
+
+
+def decrypt_message(group, x, b, c1, e0, e1):
+    """
+    Receiver step retrieving the chosen message of the Bellare-Micali OT.
+        Returns:
+            mb: the message chosen by the bit b
+    """
+    e = e1 if b else e0
+    return xor_bytes(e, ot_hash(group.pow(c1, x), len(e)))
+
+
+def prg(seed, nonce, num_bits):
+    # expands a seed into a num_bits integer
+    stream = hashlib.shake_256(seed + nonce.to_bytes(8, 'big')).digest((num_bits + 7) // 8)
+    return int.from_bytes(stream, 'little') & ((1 << num_bits) - 1)
+
+
+def transpose(columns, num_bits):
+    """
+    Transpose a bit matrix.
+        Parameters:
+            columns: list of num_bits integers, bit j of column i is the entry (j, i)
+            num_bits: number of rows
+        Returns:
+            rows: list of num_bits integers, bit i of row j is the entry (j, i)
+    """
+    # bit j of a column is the character j of its reversed binary string
+    strings = [format(column, '0{0}b'.format(num_bits))[::-1] for column in columns]
+    return [int(''.join(reversed(bits)), 2) for bits in zip(*strings)]
+
+
+def row_hash(index, row, length):
+    # hash of a row of the OT extension matrix
+    data = index.to_bytes(8, 'big') + row.to_bytes(SECURITY_BITS // 8, 'big')
+    return hashlib.shake_256(data).digest(length)
+
+
+def to_bytes(num, num_bits):
+    return num.to_bytes((num_bits + 7) // 8, 'little')
+
+
+def from_bytes(data):
+    return int.from_bytes(data, 'little')
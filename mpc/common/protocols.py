@@ -1,20 +1,74 @@
+import base64
+import collections
+import copy
+import hashlib
+import hmac
+import json
 import pickle
 import random
+import secrets
 import sys
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.sharedctypes import RawArray
 
 from cryptography.fernet import Fernet
 
+from mpc.common.circuit import chunk_levels, circuit_fanout, circuit_levels
+from mpc.common.crypto import LABEL_BYTES, FixedKeyAES, xor_bytes
+from mpc.common.instrumentation import metrics
+
+# gates that need no garbled table when Free-XOR is enabled
+FREE_GATES = ("XOR", "XNOR", "NOT")
+# gates forwarding their input wire, they never need a garbled table
+WIRE_GATES = ("BUF",)
+# levels with fewer gates are garbled by the parent process in parallel mode
+PARALLEL_MIN_GATES = 1024
+# default bound on the memory held by a GarbledCircuitPool
+POOL_MAX_BYTES = 256 << 20
+
 
 class RandomOracle(object):
+    """
+        Random function of the session, a keyed PRF instead of a table of
+        the values drawn so far: HMAC-SHA256 of the query under a random
+        seed, so memory stays flat whatever the number of queries.
+        Parameters:
+            k: int
+                values are uniform integers from 0 to k
+            seed: bytes
+                key of the PRF, drawn at random for each session by default
+            memo_size: int
+                if set, the values of the last memo_size queries are kept
+                in a LRU cache
+    """
 
-    def __init__(self, k=sys.maxsize):
-        self.history = {}
+    def __init__(self, k=sys.maxsize, seed=None, memo_size=0):
         self.k = k
+        self.seed = seed or secrets.token_bytes(32)
+        self.memo_size = memo_size
+        self.memo = collections.OrderedDict()
+        # 64 bits more than k makes the bias of the reduction negligible
+        self.num_bytes = (k.bit_length() + 64 + 7) // 8
 
     def __call__(self, x):
-        if x not in self.history:
-            self.history[x] = random.randint(0, self.k)
-        return self.history[x]
+        if self.memo_size:
+            if x in self.memo:
+                self.memo.move_to_end(x)
+                return self.memo[x]
+        value = self.prf(x)
+        if self.memo_size:
+            self.memo[x] = value
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return value
+
+    def prf(self, x):
+        data = repr(x).encode('utf-8')
+        stream = b''.join(hmac.new(self.seed, i.to_bytes(4, 'big') + data, hashlib.sha256).digest()
+                          for i in range((self.num_bytes + 31) // 32))
+        return int.from_bytes(stream[:self.num_bytes], 'big') % (self.k + 1)
 
 
 def encrypt(key, data: bytes):
@@ -43,12 +97,17 @@ def decrypt(key, data):
     return f.decrypt(data)
 
 
-def is_unary_op(gate_in, wire_inputs):
-    return (len(gate_in) < 2) and (gate_in[0] in wire_inputs)
-
-
-def is_binary_operator(gate_in, wire_inputs):
-    return (gate_in[0] in wire_inputs) and (gate_in[1] in wire_inputs)
+def xor_keys(key1, key2):
+    """
+    XOR two Fernet keys.
+        Parameters:
+            key1: the first url-safe base64 encoded key
+            key2: the second url-safe base64 encoded key
+        Returns:
+            key: the url-safe base64 encoded XOR of the two keys
+    """
+    raw = xor_bytes(base64.urlsafe_b64decode(key1), base64.urlsafe_b64decode(key2))
+    return base64.urlsafe_b64encode(raw)
 
 
 class GarbledCircuit:
@@ -72,33 +131,64 @@ class GarbledCircuit:
                         ]
                     }
                 }
+            an optional "const" dict maps constant wires to their bit
+            specs of a CompiledCircuit also carry the number of wires,
+            the levels and the fan-out of the wires
         p_bits: dict
             p-bits for the given circuit
+        free_xor: bool
+            if True, the two keys of every wire differ by a global offset,
+            so that XOR, XNOR and NOT gates need no garbled table
+        engine: str
+            name of the garbling engine, either 'fernet' or 'half-gates'
+        stream: bool
+            if True, tables are not garbled upfront but chunk by chunk with `stream`
+        workers: int
+            if greater than 1, the gates of each level are garbled by a pool
+            of processes, only with the half-gates engine
     """
 
-    def __init__(self, circuit, p_bits=None):
+    def __init__(self, circuit, p_bits=None, free_xor=False, engine='fernet', stream=False, workers=None):
         if p_bits is None:
             p_bits = {}
+        self.circuit = circuit
         self.name = circuit['name']
         self.output = circuit['out']
         self.gates = circuit["gates"]  # list of gates
+        self.levels = circuit_levels(circuit)  # gate positions by dependency level
         self.wires = None  # list of circuit wires
+        self.engine = get_engine(engine)  # garbling engine
+        self.free_xor = free_xor or self.engine.requires_free_xor
+        self.delta = None  # global offset between the two keys of a wire
 
         self.p_bits = {}  # dict of p-bits
         self.keys = {}  # dict of keys
-        self.garbled_tables = {}  # dict of garbled table
+        self.garbled_tables = None  # garbled tables
+        self.out_p_bits = {}  # dict of p-bits of output wires
 
-        self._init_wires()
+        self._init_wires(circuit.get("wires"))
         self._init_p_bits(p_bits)
         self._init_keys()
-        self._init_garbled_tables()
-        self.out_p_bits = {wire: self.p_bits[wire] for wire in self.output}
-
-    def _init_wires(self):
+        if not stream:
+            with metrics.span('garble', engine=self.engine.name):
+                if workers and workers > 1:
+                    self._init_garbled_tables_parallel(workers)
+                else:
+                    self._init_garbled_tables()
+            self.out_p_bits = {wire: self.p_bits[wire] for wire in self.output}
+            metrics.count('gates', len(self.gates), phase='garble')
+
+    def _init_wires(self, num_wires=None):
         """
             Retrieve all wire IDs from the circuit.
+            Compiled circuits have dense IDs from 0 to num_wires - 1.
         """
-        wires = set()
+        if num_wires is not None:
+            self.wires = list(range(num_wires))
+            return
+        # inputs of the parties and constants may be read by no gate, as in some Bristol circuits
+        wires = set(self.circuit['alice'] + self.circuit['bob'])
+        wires.update(int(wire) for wire in self.circuit.get('const', {}))
         for gate in self.gates:
             wires.add(gate["id"])
             wires.update(set(gate["in"]))
@@ -108,22 +198,134 @@ class GarbledCircuit:
         """
             Creates a dict mapping each wire to a random p-bit.
         """
-        self.p_bits = p_bits or {wire: random.randint(0, 1) for wire in self.wires}
+        self.p_bits = dict(p_bits) if p_bits else {wire: random.randint(0, 1) for wire in self.wires}
 
     def _init_keys(self):
         """
             Creates pair of keys for each wire.
+            The keys of the output wires of free gates, and of every gate
+            when the engine derives them, are created while garbling.
         """
+        if self.free_xor:
+            self.delta = self.engine.generate_delta()
+
+        derived = {gate["id"] for gate in self.gates if self._is_free(gate) or self.engine.derives_keys}
+        for wire in self.wires:
+            if wire not in derived:
+                self.keys[wire] = self.engine.generate_keys(self.p_bits[wire], self.delta)
 
-        self.keys = {wire: (Fernet.generate_key(), Fernet.generate_key()) for wire in self.wires}
+    def _is_free(self, gate):
+        return gate["type"] in WIRE_GATES or (self.free_xor and gate["type"] in FREE_GATES)
 
     def _init_garbled_tables(self):
         """
-            Creates the garbled table of each gate.
+            Creates the garbled table of each gate,
+            garbling one dependency level at a time.
         """
-        for gate in self.gates:
-            g_gate = GarbledGate(gate, self.keys, self.p_bits)
-            self.garbled_tables[gate["id"]] = g_gate.get_garbled_table()
+        self.garbled_tables = GarbledTable(len(self.gates), self.engine.row_size)
+        for level in self.levels:
+            self._garble_gates(level, self.garbled_tables, level)
+
+    def _init_garbled_tables_parallel(self, workers):
+        """
+            Creates the garbled tables with a pool of processes.
+            The zero labels of the wires and the rows of the tables live in
+            shared memory, the processes garble slices of each level in place
+            and the parent only waits for a level before starting the next.
+        """
+        if not self.engine.derives_keys:
+            raise ValueError("Parallel garbling requires the {0} engine".format(HalfGatesEngine.name))
+
+        offsets = array('q', [-1]) * len(self.gates)
+        size = 0
+        for position, gate in enumerate(self.gates):
+            if not self._is_free(gate):
+                offsets[position], size = size, size + self.engine.rows(gate) * self.engine.row_size
+        wires = {wire: index for index, wire in enumerate(self.wires)}
+        labels = RawArray('B', len(wires) * LABEL_BYTES)
+        data = RawArray('B', size)
+
+        garbler = _SharedGarbler(labels, data, self.gates, wires, offsets, self.delta, self.engine.name)
+        for wire, (key_0, _) in self.keys.items():
+            garbler.write(wire, key_0)
+
+        args = (labels, data, self.gates, wires, offsets, self.delta, self.engine.name)
+        with ProcessPoolExecutor(workers, initializer=_init_garbler, initargs=args) as executor:
+            for level in self.levels:
+                if len(level) < PARALLEL_MIN_GATES:
+                    garbler.garble(level)
+                    continue
+                step = -(-len(level) // workers)
+                list(executor.map(_garble, [level[start:start + step] for start in range(0, len(level), step)]))
+
+        self.garbled_tables = GarbledTable(len(self.gates), self.engine.row_size, bytearray(data), offsets)
+        for wire in self.output:
+            key_0 = garbler.read(wire)
+            self.keys[wire] = (key_0, self.engine.xor(key_0, self.delta))
+            self.p_bits[wire] = key_0[-1] & 1
+
+    def _garble_gates(self, positions, table, indices):
+        """
+            Garbles independent gates.
+            Parameters:
+                positions: positions of the gates in the circuit
+                table: GarbledTable receiving the rows of the gates
+                indices: index of each gate in the table
+        """
+        garbled, targets = [], []
+        for position, index in zip(positions, indices):
+            if self._is_free(self.gates[position]):
+                self._init_free_gate(self.gates[position])
+            else:
+                garbled.append(self.gates[position])
+                targets.append(index)
+
+        tables = self.engine.garble_level(garbled, self.keys, self.p_bits, self.delta)
+        for index, rows in zip(targets, tables):
+            table.append(index, rows)
+
+    def stream(self, chunk_size):
+        """
+            Garbles the circuit in topological order, chunk by chunk.
+            Keys of a wire are dropped once all the gates reading it are
+            garbled, so memory depends on the width of the circuit.
+            Must be called after the input labels have been encoded.
+            Parameters:
+                chunk_size: maximum number of gates of a chunk
+            Yields:
+                table: GarbledTable of the gates of the chunk, by index in the chunk
+                out_p_bits: dict of p-bits of the output wires of the chunk
+        """
+        output = set(self.output)
+        readers = circuit_fanout(self.circuit)
+        for positions in chunk_levels(self.levels, chunk_size):
+            table = GarbledTable(len(positions), self.engine.row_size)
+            with metrics.span('garble_chunk', engine=self.engine.name):
+                self._garble_gates(positions, table, range(len(positions)))
+            metrics.count('gates', len(positions), phase='garble')
+
+            out_p_bits = {}
+            for position in positions:
+                gate = self.gates[position]
+                if gate["id"] in output:
+                    out_p_bits[gate["id"]] = self.p_bits[gate["id"]]
+                if not readers[gate["id"]]:
+                    self._release(gate["id"], output)
+                for wire in gate["in"]:
+                    readers[wire] -= 1
+                    if not readers[wire]:
+                        self._release(wire, output)
+
+            self.out_p_bits.update(out_p_bits)
+            yield table, out_p_bits
+
+    def _release(self, wire, output):
+        self.keys.pop(wire, None)
+        if wire not in output:
+            self.p_bits.pop(wire, None)
+
+    def _init_free_gate(self, gate):
+        garble_free_gate(self.engine, gate, self.keys, self.p_bits, self.delta)
 
     def print_garbled_tables(self):
         """
@@ -136,73 +338,251 @@ class GarbledCircuit:
             print("* {0}: {1}".format(wire, p_bit))
         print()
 
-        for gate in self.gates:
-            garbled_table = GarbledGate(gate, self.keys, self.p_bits)
-            garbled_table.print_garbled_table()
+        for position, gate in enumerate(self.gates):
+            if self._is_free(gate):
+                continue
+            if self.engine.name == FernetEngine.name:
+                garbled_table = GarbledGate(gate, self.keys, self.p_bits)
+                garbled_table.print_garbled_table()
+            else:
+                print("GATE: {0}, TYPE: {1}".format(gate["id"], gate["type"]))
+                for index in range(self.engine.rows(gate)):
+                    print(self.garbled_tables.row(position, index).hex())
             print()
 
     @staticmethod
-    def evaluate(circuit, g_tables, p_bits_out, a_inputs, b_inputs):
+    def evaluate(circuit, g_tables, p_bits_out, a_inputs, b_inputs, free_xor=False, engine='fernet'):
         """
         Evaluate yao circuit with given secrets.
             Parameters:
                 circuit: dict
                     containing circuit spec
-                g_tables: dict
-                    garbled table of yao circuit
+                g_tables: GarbledTable
+                    garbled tables of yao circuit
                 p_bits_out: dict
                     p-bits of outputs
                 a_inputs: dict
                     mapping Alice's wires to (key, encr_bit) secrets
                 b_inputs: dict
                     mapping Bob's wires to (key, encr_bit) secrets
+                free_xor: bool
+                    whether the circuit was garbled with Free-XOR
+                engine: str
+                    name of the engine the circuit was garbled with
             Returns:
                 evaluation: dict
                     mapping output wires with the result bit
         """
-        gates = circuit['gates']  # dict containing circuit gates
-        wire_outputs = circuit['out']  # list of output wires
-        wire_inputs = {}  # dict containing Alice and Bob secrets
-        evaluation = {}  # dict containing result of evaluation
-
-        wire_inputs.update(a_inputs)
-        wire_inputs.update(b_inputs)
-        # Iterate over all gates
-        for gate in sorted(gates, key=lambda g: g["id"]):
-            gate_id, gate_in, msg = gate["id"], gate["in"], None
-
-            # Special case if it's a NOT gate
-            if is_unary_op(gate_in, wire_inputs):
-                # Fetch input key associated with the gate's input wire
-                key_in, bit_in = wire_inputs[gate_in[0]]
-                # Fetch the encrypted message in the gate's garbled table
-                encrypted_msg = g_tables[gate_id][(bit_in,)]
-                # Decrypt message
-                msg = decrypt(key_in, encrypted_msg)
-
-            # Else the gate has two input wires (same model)
-            elif is_binary_operator(gate_in, wire_inputs):
-                key_a, bit_a = wire_inputs[gate_in[0]]
-                key_b, bit_b = wire_inputs[gate_in[1]]
-                encrypted_msg = g_tables[gate_id][(bit_a, bit_b)]
-                msg = decrypt(key_b, decrypt(key_a, encrypted_msg))
-
-            if msg:
-                wire_inputs[gate_id] = pickle.loads(msg)
-
-        # After all gates have been evaluated, we populate the dict of results
-        for out in wire_outputs:
-            evaluation[out] = wire_inputs[out][1] ^ p_bits_out[out]
-
-        return evaluation
+        with metrics.span('evaluate', engine=engine):
+            evaluator = GarbledEvaluator(circuit, a_inputs, b_inputs, free_xor=free_xor, engine=engine)
+            # Gates of a level are independent, the garbled ones are evaluated in one batch
+            for level in evaluator.levels:
+                evaluator.evaluate(level, g_tables, level)
+            metrics.count('gates', len(evaluator.gates), phase='evaluate')
+            return evaluator.decode(p_bits_out)
 
     def encode_labels(self, inputs, wires):
         return {wire: (self.keys[wire][inp], self.p_bits[wire] ^ inp) for inp, wire in zip(inputs, wires)}
 
+    def encode_constants(self):
+        # constant wires are inputs of the garbler
+        constants = {int(wire): bit for wire, bit in self.circuit.get("const", {}).items()}
+        return self.encode_labels(list(constants.values()), list(constants))
+
     def keys_of_wires(self, b_wires):
         return {w: ((self.keys[w][0], 0 ^ self.p_bits[w]), (self.keys[w][1], 1 ^ self.p_bits[w])) for w in b_wires}
 
 
+class GarbledCircuitPool(object):
+    """
+    Circuits garbled ahead of time, for an offline/online split of Yao's protocol.
+    Instances are identified by a hash of the circuit and the garbling options,
+    are handed out at most once and the oldest are evicted when the pool is full.
+
+    Parameters:
+        max_bytes: int
+            bound on the size of the tables and keys held by the pool
+    """
+
+    def __init__(self, max_bytes=POOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0  # bytes held by the pool
+        self.instances = collections.OrderedDict()  # (key, counter) -> (circuit, size), oldest first
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.instances)
+
+    @staticmethod
+    def key(circuit_spec, free_xor=False, engine='fernet'):
+        # circuits of the same name may differ, the key covers their wires and gates
+        content = [circuit_spec[field] for field in ('alice', 'bob', 'out', 'gates')]
+        content.append({str(wire): bit for wire, bit in circuit_spec.get('const', {}).items()})
+        digest = hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+        return digest, free_xor, engine
+
+    def garble(self, circuit_spec, count, free_xor=False, engine='fernet', workers=None):
+        """
+            Garbles count instances of a circuit, the offline phase.
+        """
+        key = self.key(circuit_spec, free_xor, engine)
+        inputs = circuit_spec['alice'] + circuit_spec['bob'] + [int(wire) for wire in circuit_spec.get('const', {})]
+        for _ in range(count):
+            circuit = GarbledCircuit(circuit_spec, free_xor=free_xor, engine=engine, workers=workers)
+            # only the keys of the inputs are needed online
+            circuit.keys = {wire: circuit.keys[wire] for wire in inputs}
+            circuit.p_bits = {wire: circuit.p_bits[wire] for wire in inputs}
+            self.put(key, circuit)
+
+    def put(self, key, circuit):
+        size = len(circuit.garbled_tables) + sum(len(k) for keys in circuit.keys.values() for k in keys)
+        with self.lock:
+            self.counter += 1
+            self.instances[key, self.counter] = (circuit, size)
+            self.size += size
+            while self.size > self.max_bytes and self.instances:
+                _, (_, evicted) = self.instances.popitem(last=False)
+                self.size -= evicted
+
+    def pop(self, circuit_spec, free_xor=False, engine='fernet'):
+        """
+            Removes the oldest instance of a circuit from the pool.
+            Returns:
+                circuit: a GarbledCircuit, None if there is none ready
+        """
+        key = self.key(circuit_spec, free_xor, engine)
+        with self.lock:
+            for entry in self.instances:
+                if entry[0] == key:
+                    circuit, size = self.instances.pop(entry)
+                    self.size -= size
+                    return circuit
+        return None
+
+
+def garble_free_gate(engine, gate, keys, p_bits, delta):
+    """
+        Derives keys and p-bit of the output wire of a free gate.
+        XOR: k_out = k_a ^ k_b, NOT and XNOR swap the output keys,
+        BUF forwards the keys of its input.
+    """
+    gate_in, out = gate["in"], gate["id"]
+
+    if gate["type"] in WIRE_GATES:
+        keys[out] = keys[gate_in[0]]
+        p_bits[out] = p_bits[gate_in[0]]
+        return
+
+    if gate["type"] == "NOT":
+        key_0, key_1 = keys[gate_in[0]]
+        p_bit = p_bits[gate_in[0]]
+    else:
+        key_0 = engine.xor(keys[gate_in[0]][0], keys[gate_in[1]][0])
+        key_1 = engine.xor(key_0, delta)
+        p_bit = p_bits[gate_in[0]] ^ p_bits[gate_in[1]]
+
+    if gate["type"] == "XOR":
+        keys[out] = (key_0, key_1)
+        p_bits[out] = p_bit
+    else:
+        keys[out] = (key_1, key_0)
+        p_bits[out] = p_bit ^ 1
+
+
+class GarbledEvaluator:
+    """
+        Evaluator of a garbled circuit, fed with the garbled tables
+        of independent gates in topological order.
+        Labels of a wire are dropped once all the gates reading it are
+        evaluated, so memory depends on the width of the circuit.
+        Parameters:
+            circuit: dict
+                containing circuit spec
+            a_inputs: dict
+                mapping Alice's wires to (key, encr_bit) secrets
+            b_inputs: dict
+                mapping Bob's wires to (key, encr_bit) secrets
+            free_xor: bool
+                whether the circuit was garbled with Free-XOR
+            engine: str
+                name of the engine the circuit was garbled with
+    """
+
+    def __init__(self, circuit, a_inputs, b_inputs, free_xor=False, engine='fernet'):
+        self.engine = get_engine(engine)  # garbling engine
+        self.free_xor = free_xor or self.engine.requires_free_xor
+        self.gates = circuit['gates']  # list of gates
+        self.levels = circuit_levels(circuit)  # gate positions by dependency level
+        self.output = circuit['out']  # list of output wires
+        self.output_wires = set(self.output)  # set of output wires
+        self.fanout = circuit_fanout(circuit)  # number of gates reading each wire
+        self.readers = None  # number of gates still reading each wire
+        self.wire_inputs = None  # dict mapping wires to their active (key, encr_bit)
+        self.reset(a_inputs, b_inputs)
+
+    def reset(self, a_inputs, b_inputs):
+        """
+            Starts over with the inputs of another garbling of the circuit,
+            keeping the levels and the fan-out computed once.
+            Parameters:
+                a_inputs: dict
+                    mapping Alice's wires to (key, encr_bit) secrets
+                b_inputs: dict
+                    mapping Bob's wires to (key, encr_bit) secrets
+        """
+        self.readers = copy.copy(self.fanout)
+        self.wire_inputs = dict(a_inputs)
+        self.wire_inputs.update(b_inputs)
+
+    def evaluate(self, positions, g_tables, indices):
+        """
+            Evaluates independent gates.
+            Parameters:
+                positions: positions of the gates in the circuit
+                g_tables: GarbledTable holding the rows of the gates
+                indices: index of each gate in the table
+        """
+        wire_inputs, engine = self.wire_inputs, self.engine
+        garbled, targets = [], []
+        for position, index in zip(positions, indices):
+            gate = self.gates[position]
+            gate_id, gate_in = gate["id"], gate["in"]
+
+            # Free gates have no garbled table
+            if gate["type"] in WIRE_GATES or (self.free_xor and gate["type"] in FREE_GATES):
+                if gate["type"] == "NOT" or gate["type"] in WIRE_GATES:
+                    # NOT swaps the keys of the wire, the active label is unchanged
+                    wire_inputs[gate_id] = wire_inputs[gate_in[0]]
+                else:
+                    key_a, bit_a = wire_inputs[gate_in[0]]
+                    key_b, bit_b = wire_inputs[gate_in[1]]
+                    wire_inputs[gate_id] = (engine.xor(key_a, key_b), bit_a ^ bit_b)
+            else:
+                garbled.append(gate)
+                targets.append(index)
+
+        labels = engine.evaluate_level(garbled, g_tables, targets, wire_inputs)
+        for gate, label in zip(garbled, labels):
+            wire_inputs[gate["id"]] = label
+
+        for position in positions:
+            gate = self.gates[position]
+            for wire in gate["in"]:
+                self.readers[wire] -= 1
+                if not self.readers[wire] and wire not in self.output_wires:
+                    wire_inputs.pop(wire, None)
+
+    def decode(self, p_bits_out):
+        """
+            Decodes the output wires once all the gates have been evaluated.
+            Returns:
+                evaluation: dict
+                    mapping output wires with the result bit
+        """
+        return {out: self.wire_inputs[out][1] ^ p_bits_out[out] for out in self.output}
+
+
 class GarbledGate:
     """
         A represent action of a garbled gate.
@@ -316,3 +696,308 @@ class GarbledGate:
             Returns the garbled table of the gate.
         """
         return self.garbled_table
+
+
+class FernetEngine(object):
+    """
+        Garbling engine encrypting every row of the table twice with Fernet.
+    """
+
+    name = 'fernet'
+    requires_free_xor = False  # Free-XOR is optional
+    derives_keys = False  # output keys are chosen at random
+
+    def __init__(self):
+        # rows are padded to the size of a doubly encrypted row,
+        # Fernet tokens are base64 so the padding is unambiguous
+        key = Fernet.generate_key()
+        self.row_size = len(encrypt(key, encrypt(key, pickle.dumps((key, 1)))))
+
+    @staticmethod
+    def generate_delta():
+        return Fernet.generate_key()
+
+    @staticmethod
+    def generate_keys(p_bit, delta=None):
+        # the p-bit is independent from Fernet keys
+        key = Fernet.generate_key()
+        return key, xor_keys(key, delta) if delta else Fernet.generate_key()
+
+    @staticmethod
+    def xor(key1, key2):
+        return xor_keys(key1, key2)
+
+    @staticmethod
+    def rows(gate):
+        return 2 if gate["type"] == "NOT" else 4
+
+    def garble_level(self, gates, keys, p_bits, delta=None):
+        # rows sorted by encrypted bits are addressed by 2 * bit_a + bit_b
+        tables = (GarbledGate(gate, keys, p_bits).get_garbled_table() for gate in gates)
+        return [[table[bits].ljust(self.row_size, b"\0") for bits in sorted(table)] for table in tables]
+
+    def evaluate_level(self, gates, table, positions, wire_inputs):
+        return [self.evaluate(gate, table, position, wire_inputs) for gate, position in zip(gates, positions)]
+
+    @staticmethod
+    def evaluate(gate, table, position, wire_inputs):
+        gate_in = gate["in"]
+
+        # Special case if it's a NOT gate
+        if gate["type"] == "NOT":
+            # Fetch input key associated with the gate's input wire
+            key_in, bit_in = wire_inputs[gate_in[0]]
+            # Fetch the encrypted message in the gate's garbled table
+            encrypted_msg = bytes(table.row(position, bit_in)).rstrip(b"\0")
+            # Decrypt message
+            msg = decrypt(key_in, encrypted_msg)
+
+        # Else the gate has two input wires (same model)
+        else:
+            key_a, bit_a = wire_inputs[gate_in[0]]
+            key_b, bit_b = wire_inputs[gate_in[1]]
+            encrypted_msg = bytes(table.row(position, 2 * bit_a + bit_b)).rstrip(b"\0")
+            msg = decrypt(key_b, decrypt(key_a, encrypted_msg))
+
+        return pickle.loads(msg)
+
+
+class HalfGatesEngine(object):
+    """
+        Half-gates garbling engine (Zahur, Rosulek and Evans).
+        Labels are 16 bytes long, the p-bit of a key is its least
+        significant bit and the hash is fixed-key AES. AND-like gates
+        take two ciphertexts, XOR-like gates are free.
+    """
+
+    name = 'half-gates'
+    requires_free_xor = True
+    derives_keys = True  # output keys of AND-like gates come from the table
+    row_size = LABEL_BYTES
+
+    # (alpha, beta, gamma) such that gate(a, b) = ((a ^ alpha) & (b ^ beta)) ^ gamma
+    AND_GATES = {
+        "AND": (0, 0, 0),
+        "NAND": (0, 0, 1),
+        "OR": (1, 1, 1),
+        "NOR": (1, 1, 0),
+    }
+
+    def __init__(self):
+        self.hash = FixedKeyAES()
+
+    @staticmethod
+    def generate_delta():
+        # the p-bits of the two keys of a wire must differ
+        return _to_label(secrets.randbits(8 * LABEL_BYTES) | 1)
+
+    @staticmethod
+    def generate_keys(p_bit, delta):
+        key = secrets.randbits(8 * LABEL_BYTES) & ~1 | p_bit
+        return _to_label(key), _to_label(key ^ _from_label(delta))
+
+    @staticmethod
+    def xor(key1, key2):
+        return _to_label(_from_label(key1) ^ _from_label(key2))
+
+    @staticmethod
+    def rows(gate):
+        return 2
+
+    def garble_level(self, gates, keys, p_bits, delta):
+        delta = _from_label(delta)
+
+        # keys of the inputs of the underlying AND gates
+        labels, tweaks = [], []
+        for gate in gates:
+            alpha, beta, _ = self.AND_GATES[gate["type"]]
+            a_0, b_0 = _from_label(keys[gate["in"][0]][alpha]), _from_label(keys[gate["in"][1]][beta])
+            labels += (a_0, a_0 ^ delta, b_0, b_0 ^ delta)
+            tweaks += (2 * gate["id"], 2 * gate["id"], 2 * gate["id"] + 1, 2 * gate["id"] + 1)
+        # all the hashes of the level in a single call
+        hashes = self.hash(labels, tweaks)
+
+        tables = []
+        for i, gate in enumerate(gates):
+            a_0, b_0 = labels[4 * i], labels[4 * i + 2]
+            h_a0, h_a1, h_b0, h_b1 = hashes[4 * i:4 * i + 4]
+            p_a, p_b = a_0 & 1, b_0 & 1
+
+            # garbler half-gate
+            t_g = h_a0 ^ h_a1 ^ (delta if p_b else 0)
+            w_g = h_a0 ^ (t_g if p_a else 0)
+            # evaluator half-gate
+            t_e = h_b0 ^ h_b1 ^ a_0
+            w_e = h_b0 ^ (t_e ^ a_0 if p_b else 0)
+
+            key = w_g ^ w_e ^ (delta if self.AND_GATES[gate["type"]][2] else 0)
+            keys[gate["id"]] = (_to_label(key), _to_label(key ^ delta))
+            p_bits[gate["id"]] = key & 1
+            tables.append((_to_label(t_g), _to_label(t_e)))
+        return tables
+
+    def evaluate_level(self, gates, table, positions, wire_inputs):
+        labels, tweaks = [], []
+        for gate in gates:
+            labels += (_from_label(wire_inputs[gate["in"][0]][0]), _from_label(wire_inputs[gate["in"][1]][0]))
+            tweaks += (2 * gate["id"], 2 * gate["id"] + 1)
+        # all the hashes of the level in a single call
+        hashes = self.hash(labels, tweaks)
+
+        results = []
+        for i, (gate, position) in enumerate(zip(gates, positions)):
+            key_a, h_a, h_b = labels[2 * i], hashes[2 * i], hashes[2 * i + 1]
+            bit_a, bit_b = wire_inputs[gate["in"][0]][1], wire_inputs[gate["in"][1]][1]
+            t_g, t_e = _from_label(table.row(position, 0)), _from_label(table.row(position, 1))
+            key = h_a ^ (t_g if bit_a else 0) ^ h_b ^ (t_e ^ key_a if bit_b else 0)
+            results.append((_to_label(key), key & 1))
+        return results
+
+
+class GarbledTable(object):
+    """
+        Garbled tables of a circuit stored in one contiguous buffer.
+        Parameters:
+            size: int
+                number of gates in the circuit
+            row_size: int
+                size in bytes of every row of the tables
+            data: bytearray
+                rows of all the tables one after the other
+            offsets: array
+                offset of the first row of each gate, by position
+                of the gate in the circuit, -1 if it has no table
+    """
+
+    def __init__(self, size, row_size, data=None, offsets=None):
+        self.row_size = row_size
+        self.data = bytearray() if data is None else data
+        self.offsets = array('q', [-1]) * size if offsets is None else offsets
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, position, rows):
+        """
+            Appends the rows of the gate at the given position.
+        """
+        self.offsets[position] = len(self.data)
+        for row in rows:
+            if len(row) != self.row_size:
+                raise ValueError("Row of {0} bytes in a table of {1} bytes rows".format(len(row), self.row_size))
+            self.data += row
+
+    def row(self, position, index):
+        """
+            Returns a view of a row of the gate at the given position.
+        """
+        start = self.offsets[position] + index * self.row_size
+        return memoryview(self.data)[start:start + self.row_size]
+
+    def dump(self):
+        offsets = array('q', self.offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return {'row_size': self.row_size, 'offsets': offsets.tobytes(), 'data': self.data}
+
+    @classmethod
+    def load(cls, data):
+        offsets = array('q', data['offsets'])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        # a bytearray received in place by the connection is used as is
+        rows = data['data'] if isinstance(data['data'], bytearray) else bytearray(data['data'])
+        return cls(len(offsets), data['row_size'], rows, offsets)
+
+
+class _SharedGarbler(object):
+    """
+        Half-gates garbling of slices of a level over shared memory.
+        The two keys of a wire differ by delta and its p-bit is the last
+        bit of its zero label, so the zero labels are all the state.
+    """
+
+    def __init__(self, labels, data, gates, wires, offsets, delta, engine):
+        self.labels = memoryview(labels).cast('B')
+        self.data = memoryview(data).cast('B')
+        self.gates = gates
+        self.wires = wires  # index of each wire in labels
+        self.offsets = offsets
+        self.delta = delta
+        self.engine = get_engine(engine)
+
+    def read(self, wire):
+        start = self.wires[wire] * LABEL_BYTES
+        return bytes(self.labels[start:start + LABEL_BYTES])
+
+    def write(self, wire, label):
+        start = self.wires[wire] * LABEL_BYTES
+        self.labels[start:start + LABEL_BYTES] = label
+
+    def garble(self, positions):
+        gates = [self.gates[position] for position in positions]
+        keys, p_bits = {}, {}
+        for gate in gates:
+            for wire in gate["in"]:
+                key_0 = self.read(wire)
+                keys[wire] = (key_0, self.engine.xor(key_0, self.delta))
+                p_bits[wire] = key_0[-1] & 1
+
+        garbled = []
+        for position, gate in zip(positions, gates):
+            if gate["type"] in FREE_GATES or gate["type"] in WIRE_GATES:
+                garble_free_gate(self.engine, gate, keys, p_bits, self.delta)
+            else:
+                garbled.append(position)
+        tables = self.engine.garble_level([self.gates[position] for position in garbled], keys, p_bits, self.delta)
+
+        for gate in gates:
+            self.write(gate["id"], keys[gate["id"]][0])
+        for position, rows in zip(garbled, tables):
+            start = self.offsets[position]
+            self.data[start:start + len(rows) * self.engine.row_size] = b"".join(rows)
+
+
+_garbler = None  # _SharedGarbler of a worker process
+
+
+def _init_garbler(*args):
+    global _garbler
+    _garbler = _SharedGarbler(*args)
+
+
+def _garble(positions):
+    _garbler.garble(positions)
+
+
+def pack_label(key, bit):
+    # (key, encrypted bit) as bytes, the form of the labels sent by OT
+    return bytes(key) + bytes([bit])
+
+
+def unpack_label(data):
+    return bytes(data[:-1]), data[-1]
+
+
+def _to_label(num):
+    return num.to_bytes(LABEL_BYTES, 'big')
+
+
+def _from_label(label):
+    return int.from_bytes(label, 'big')
+
+
+ENGINES = {engine.name: engine for engine in (FernetEngine, HalfGatesEngine)}
+
+
+def get_engine(name):
+    """
+    Creates a garbling engine.
+        Parameters:
+            name: the name of the engine
+        Returns:
+            engine: a new instance of the engine
+    """
+    if name not in ENGINES:
+        raise ValueError("Unknown garbling engine: {0}".format(name))
+    return ENGINES[name]()
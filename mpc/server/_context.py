@@ -1,11 +1,14 @@
+from mpc.common.instrumentation import metrics
 from mpc.server._factories import ProtocolFactory
 
 
 class Context(object):
 
-    def __init__(self, socket):
+    def __init__(self, socket, properties=None, session_id=0):
         self.socket = socket
-        self.__protocols = ProtocolFactory.create(socket=socket)
+        self.session_id = session_id
+        self.__protocols = ProtocolFactory.create(properties, socket=socket, session_id=session_id)
 
     def handle(self, protocol_name: str, method_name: str, **kwargs):
-        return getattr(self.__protocols[protocol_name], method_name)(**kwargs)
+        with metrics.span('handle', protocol=protocol_name, method=method_name):
+            return getattr(self.__protocols[protocol_name], method_name)(**kwargs)
@@ -1,25 +1,34 @@
-import collections
-import importlib
+import collections.abc
+import copy
 import json
+import sys
 
 from mpc.client.client import SocketClient
-from mpc.client.protocols import YaoObliviousTransfer
+from mpc.client.protocols import OTExtension, YaoObliviousTransfer
 from mpc.common.protocols import RandomOracle
 from mpc.server._protocols import ObliviousTransfer, YaoGarbledCircuit
 
+# configuration of the protocols of the server
+PROPERTIES = 'properties.json'
+
 PROTOCOL_DEFAULTS = {
     'RandomOracle': {},
     'ObliviousTransfer': {
         'random_oracle': '@RandomOracle'
     },
     'Client': {
-        'socket': ':socket'
+        'socket': ':socket',
+        'session_id': 0
     },
     'YaoObliviousTransferClient': {
         'client': '@Client'
     },
+    'OTExtensionClient': {
+        'client': '@Client'
+    },
     'YaoGarbledCircuit': {
         'oblivious_transfer_client': '@YaoObliviousTransferClient',
+        'ot_extension_client': '@OTExtensionClient',
         'client': '@Client',
     }
 }
@@ -29,12 +38,12 @@ def deep_merge(this, other):
     def rec(a, b):
         for k, v in b.items():
             if (k in a and isinstance(a[k], dict)
-                    and isinstance(b[k], collections.Mapping)):
+                    and isinstance(b[k], collections.abc.Mapping)):
                 rec(a[k], b[k])
             else:
                 a[k] = b[k]
 
-    this = this.copy()
+    this = copy.deepcopy(this)
     rec(this, other)
     return this
 
@@ -50,21 +59,27 @@ def substitute(this, other):
 class ProtocolFactory(object):
 
     @classmethod
-    def create(cls, **kwargs):
-        file_properties = json.load(open('properties.json'))
-        properties = deep_merge(PROTOCOL_DEFAULTS, file_properties)
+    def create(cls, properties=None, **kwargs):
+        if properties is None:
+            properties = cls.load()
 
         protocols = {}
 
+        module = sys.modules[cls.__module__]
         for k, v in properties.items():
             v = substitute(v, protocols)
-            module = importlib.import_module(cls.__module__)
             factory = getattr(module, f'{k}Factory')
             w = override(v, kwargs)
             protocols[k] = factory.create(**w)
 
         return protocols
 
+    @staticmethod
+    def load(path=PROPERTIES):
+        with open(path) as f:
+            file_properties = json.load(f)
+        return deep_merge(PROTOCOL_DEFAULTS, file_properties)
+
 
 class ObliviousTransferFactory:
 
@@ -99,3 +114,10 @@ class YaoObliviousTransferClientFactory:
     @staticmethod
     def create(**kwargs):
         return YaoObliviousTransfer(**kwargs)
+
+
+class OTExtensionClientFactory:
+
+    @staticmethod
+    def create(**kwargs):
+        return OTExtension(**kwargs)
@@ -0,0 +1,41 @@
+from mpc.common.crypto import GROUPS
+from mpc.server._context import Context
+from mpc.server._factories import PROPERTIES, ProtocolFactory
+
+
+class Lifecycle(object):
+    """
+        Manages the state the sessions of a server share.
+        The configuration is loaded and merged with the defaults once, when
+        the server starts. Each session then gets a Context of new protocol
+        objects, which only hold the state of that session, while the heavy
+        immutable state (prime groups and their tables, compiled circuits)
+        lives in process-wide caches reused by every session.
+        The "Groups" entry of the properties, if any, holds the arguments of
+        GroupProvider.configure for the groups of the oblivious transfers.
+        Parameters:
+            path: str
+                path of the properties of the protocols
+    """
+
+    def __init__(self, path=PROPERTIES):
+        self.properties = ProtocolFactory.load(path)
+        self.groups = self.properties.pop('Groups', None)
+        if self.groups:
+            GROUPS.configure(**self.groups)
+
+    def context(self, socket, session_id=0):
+        """
+            Creates the Context of a new session.
+            Parameters:
+                socket: socket of the session
+                session_id: id of the session on a multiplexed connection
+            Returns:
+                context: Context
+        """
+        return Context(socket, self.properties, session_id)
+
+    def close(self):
+        # saves the random groups left for the next start
+        if self.groups:
+            GROUPS.close()
@@ -1,94 +1,290 @@
-import codecs
-import pickle
+import queue
 import random
+import secrets
+import threading
 
 from Crypto import Random
 from Crypto.PublicKey import RSA
 
-from mpc.common.crypto import PrimeGroup, ot_hash, xor_bytes
-from mpc.common.protocols import GarbledCircuit
+from mpc.common.circuit import chunk_levels
+from mpc.common.crypto import DEFAULT_GROUP, GROUPS, xor_bytes
+from mpc.common.instrumentation import metrics
+from mpc.common.ot import FIXED_BASE_BATCH, SECURITY_BITS, choose_key, decrypt_message, encrypt_messages, from_bytes, prg, row_hash, transpose
+from mpc.common.protocols import GarbledCircuit, GarbledEvaluator, GarbledTable, unpack_label
 
 
-def generate_rsa():
-    # TODO wrap into class and use DI to inject into OT
+# size of the RSA moduli of the oblivious transfers
+RSA_BITS = 1024
+# number of RSA keys generated ahead of time by the shared pool
+RSA_POOL_SIZE = 8
+
+
+def generate_rsa(bits=RSA_BITS):
     # TODO switch to cryptography instead of pycrypto
     random_generator = Random.new().read
-    return RSA.generate(1024, random_generator)
+    return RSA.generate(bits, random_generator)
+
+
+def rsa_decrypt(key, c):
+    """
+    Raw RSA decryption with the Chinese remainder theorem.
+        Parameters:
+            key: private RSA key, with u the inverse of p modulo q
+            c: integer modulo n
+        Returns:
+            m: c^d mod n
+    """
+    m_p = pow(c, key.d % (key.p - 1), key.p)
+    m_q = pow(c, key.d % (key.q - 1), key.q)
+    return m_p + key.p * ((key.u * (m_q - m_p)) % key.q)
+
+
+class RSAKeyPool(object):
+    """
+        RSA keys generated ahead of time by a background thread, so that a
+        transfer does not wait for a key generation. The thread starts with
+        the first key taken and keeps pool_size keys ready. Every key is
+        handed out once; if the pool is empty, one is generated on the spot.
+        Parameters:
+            pool_size: int
+                number of keys kept ready
+            bits: int
+                size of the moduli
+    """
+
+    def __init__(self, pool_size=RSA_POOL_SIZE, bits=RSA_BITS):
+        self.pool_size = pool_size
+        self.bits = bits
+        self.pool = queue.Queue()  # pre-generated keys
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()  # set when the pool has to be refilled
+        self.worker = None
+
+    def get(self):
+        with self.lock:
+            if self.worker is None and self.pool_size:
+                self.worker = threading.Thread(target=self._fill, daemon=True)
+                self.worker.start()
+        try:
+            key = self.pool.get_nowait()
+        except queue.Empty:
+            key = generate_rsa(self.bits)
+        self.wanted.set()
+        return key
+
+    def _fill(self):
+        while True:
+            if self.pool.qsize() >= self.pool_size:
+                self.wanted.wait()
+                self.wanted.clear()
+                continue
+            self.pool.put(generate_rsa(self.bits))
+
+
+# RSA keys shared by the sessions of the server
+RSA_KEYS = RSAKeyPool()
 
 
 class ObliviousTransfer(object):
+    """
+        Sender of the RSA 1-out-of-n OT.
+        Parameters:
+            secrets: list of the n integer messages, or for batches a list
+                of such lists, one for each transfer
+            random_oracle: callable drawing the random integers
+            key_pool: bool
+                if True, keys are taken from RSA_KEYS instead of being
+                generated for each transfer
+    """
 
-    def __init__(self, secrets=None, random_oracle=None):
+    def __init__(self, secrets=None, random_oracle=None, key_pool=False):
         self.random = random_oracle
         self.m = secrets
         self.x = None
         self.key = None
+        self.key_pool = key_pool
 
     def get_public_key(self):
-        self.key = generate_rsa()
-        public_key = self.key.publickey()
-        return {'n': public_key.n, 'e': public_key.e}
+        self.key = RSA_KEYS.get() if self.key_pool else generate_rsa()
+        return {'n': self.key.n, 'e': self.key.e}
 
     def get_random_integers(self):
         self.x = [self.random(m) for m in self.m]
         return {'x': self.x}
 
     def get_integers(self, v):
-        k = [self.key.decrypt(v - x) for x in self.x]
+        k = [rsa_decrypt(self.key, (v - x) % self.key.n) for x in self.x]
         _m = [m_ + k_ for m_, k_ in zip(self.m, k)]
         return {'m': _m}
 
+    def get_batch_integers(self):
+        # the public key and the random integers of every transfer in one message
+        self.x = [[self.random(m) for m in messages] for messages in self.m]
+        return dict(self.get_public_key(), x=self.x)
+
+    def get_batch_messages(self, v):
+        n = self.key.n
+        _m = [[m_ + rsa_decrypt(self.key, (v_j - x) % n) for m_, x in zip(messages, x_j)]
+              for v_j, x_j, messages in zip(v, self.x, self.m)]
+        return {'m': _m}
+
     def set_secrets(self, secrets):
         self.m = secrets
 
 
 class YaoObliviousTransfer(object):
 
-    def __init__(self, secrets=None):
+    def __init__(self, secrets=None, group=DEFAULT_GROUP):
         self.m = secrets
-        self.g = PrimeGroup()
+        self.g = GROUPS.get(group)
         self.c = None
 
     def get_keys(self):
         self.c = self.g.gen_pow(self.g.rand_int())
-        g = codecs.encode(pickle.dumps(self.g), "base64").decode()
-        return {'g': g, 'c': self.c}
+        return {'g': self.g.params(), 'c': self.c}
 
     def get_messages(self, h):
-        h1 = self.g.mul(self.c, self.g.inv(h))
-        k = self.g.rand_int()
-        c1 = self.g.gen_pow(k)
-        e0 = xor_bytes(self.m[0], ot_hash(self.g.pow(h, k), len(self.m[0])))
-        e1 = xor_bytes(self.m[1], ot_hash(self.g.pow(h1, k), len(self.m[1])))
-        e0 = codecs.encode(e0, 'base64').decode()
-        e1 = codecs.encode(e1, 'base64').decode()
+        c1, e0, e1 = encrypt_messages(self.g, self.c, h, self.m)
         return {'c1': c1, 'e0': e0, 'e1': e1}
 
+    def get_batch_messages(self, h):
+        # the secrets are a list of message pairs, one for each key in h
+        c_pow = self.g.fixed_base(self.c) if len(h) >= FIXED_BASE_BATCH else None
+        c1, e0, e1 = zip(*(encrypt_messages(self.g, self.c, h_i, m_i, c_pow) for h_i, m_i in zip(h, self.m)))
+        return {'c1': list(c1), 'e0': list(e0), 'e1': list(e1)}
+
+    def set_secrets(self, secrets):
+        self.m = secrets
+
+
+class OTExtension(object):
+    """
+        Sender of the IKNP OT extension.
+        The receiver runs SECURITY_BITS base OTs once, as sender, and this
+        side learns one of the two seeds of each base OT according to its
+        secret bits `s`. Any number of transfers then only costs hashing.
+    """
+
+    def __init__(self, secrets=None):
+        self.m = secrets  # list of message pairs of the next extension
+        self.g = None
+        self.s = None  # secret choice bits of the base OTs
+        self.x = None  # secret exponents of the base OTs
+        self.seeds = None  # seeds chosen by the bits of s
+        self.offset = 0  # number of transfers extended so far
+
+    def base_choose(self, g, c):
+        self.g = GROUPS.from_params(g)
+        self.g.precompute()
+        self.s = secrets.randbits(SECURITY_BITS)
+        bits = [(self.s >> i) & 1 for i in range(SECURITY_BITS)]
+        self.x, h = zip(*(choose_key(self.g, c, b) for b in bits))
+        return {'h': list(h)}
+
+    def base_messages(self, c1, e0, e1):
+        bits = [(self.s >> i) & 1 for i in range(SECURITY_BITS)]
+        self.seeds = [decrypt_message(self.g, *args) for args in zip(self.x, bits, c1, e0, e1)]
+        self.offset = 0
+
+    def extend(self, u):
+        num_ots = len(self.m)
+        # q_i = t_i ^ s_i * r, so that row q_j = t_j ^ r_j * s
+        columns = [(from_bytes(u_i) if (self.s >> i) & 1 else 0) ^ prg(seed, self.offset, num_ots)
+                   for i, (u_i, seed) in enumerate(zip(u, self.seeds))]
+        y0, y1 = [], []
+        for j, (q_j, (m0, m1)) in enumerate(zip(transpose(columns, num_ots), self.m)):
+            y0.append(xor_bytes(m0, row_hash(self.offset + j, q_j, len(m0))))
+            y1.append(xor_bytes(m1, row_hash(self.offset + j, q_j ^ self.s, len(m1))))
+        self.offset += num_ots
+        return {'y0': y0, 'y1': y1}
+
     def set_secrets(self, secrets):
         self.m = secrets
 
 
 class YaoGarbledCircuit(object):
 
-    def __init__(self, inputs, client, oblivious_transfer_client):
+    def __init__(self, inputs, client, oblivious_transfer_client, ot_extension_client=None):
         self.client = client
         self.inputs = inputs
         self.oblivious_transfer = oblivious_transfer_client
+        self.ot_extension = ot_extension_client
 
-    def circuit_input(self, circuit, table, output_p_bits, active_labels):
+    def circuit_input(self, circuit, table, output_p_bits, active_labels, free_xor=False, engine='fernet',
+                      chunk_size=None, ot_extension=False):
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("Invalid chunk size {0}".format(chunk_size))
         circuit = circuit
-        table = {int(k): {tuple(vi['k']): vi['h'].encode('utf-8') for vi in v} for k, v in table.items()}
-        active_labels = {int(k): (v1.encode('utf-8'), v2) for k, (v1, v2) in active_labels.items()}
+        active_labels = {int(k): tuple(v) for k, v in active_labels.items()}
         output_p_bits = {int(k): v for k, v in output_p_bits.items()}
         a_keys = active_labels
 
         wires = circuit['bob']
         clear_input = {w: i for w, i in zip(wires, self.inputs)}
-        b_keys = {}
-        for w, i in clear_input.items():
-            self.client.send('YaoGarbledCircuit', 'ot', w=w)
-            mb = self.oblivious_transfer.run(i)
-            b_keys[w] = pickle.loads(mb)
+        # all of Bob's keys at once, with hashing only when extending OTs
+        self.client.send('YaoGarbledCircuit', 'ot_batch', wires=list(clear_input))
+        if ot_extension:
+            mbs = self.ot_extension.run(list(clear_input.values()))
+        else:
+            mbs = self.oblivious_transfer.run_batch(list(clear_input.values()))
+        b_keys = {w: unpack_label(mb) for w, mb in zip(clear_input, mbs)}
         self.client.send('YaoGarbledCircuit', 'close')
-        result = GarbledCircuit.evaluate(circuit, table, output_p_bits, a_keys, b_keys)
+        if chunk_size is not None:
+            evaluator = GarbledEvaluator(circuit, a_keys, b_keys, free_xor=free_xor, engine=engine)
+            result = self.evaluate_chunks(evaluator, chunk_size)
+        else:
+            result = GarbledCircuit.evaluate(circuit, GarbledTable.load(table), output_p_bits, a_keys, b_keys,
+                                             free_xor=free_xor, engine=engine)
         return {str(k): v for k, v in result.items()}
+
+    def circuit_batch(self, circuit, tables, output_p_bits, active_labels, free_xor=False, engine='fernet',
+                      ot_extension=False):
+        """
+            Evaluates many garblings of one circuit, one for each input vector of Alice,
+            against Bob's inputs.
+            Bob's keys of all the instances are transferred with one batch of OTs,
+            and the levels and fan-out of the circuit are computed once.
+            Parameters:
+                circuit: dict
+                    circuit spec shared by the instances
+                tables: list of the garbled tables of each instance
+                output_p_bits: list of the p-bits of the outputs of each instance
+                active_labels: list of Alice's active labels of each instance
+            Returns:
+                results: list of the evaluations of the instances
+        """
+        wires = circuit['bob'][:len(self.inputs)]
+        choices = list(self.inputs[:len(wires)])
+        num_instances = len(tables)
+        self.client.send('YaoGarbledCircuit', 'ot_instances', wires=wires)
+        if ot_extension:
+            mbs = self.ot_extension.run(choices * num_instances)
+        else:
+            mbs = self.oblivious_transfer.run_batch(choices * num_instances)
+        self.client.send('YaoGarbledCircuit', 'close')
+
+        evaluator = GarbledEvaluator(circuit, {}, {}, free_xor=free_xor, engine=engine)
+        results = []
+        with metrics.span('evaluate_batch', engine=evaluator.engine.name):
+            for i, (table, p_bits, labels) in enumerate(zip(tables, output_p_bits, active_labels)):
+                a_keys = {int(k): tuple(v) for k, v in labels.items()}
+                b_keys = {w: unpack_label(mb) for w, mb in zip(wires, mbs[i * len(wires):(i + 1) * len(wires)])}
+                evaluator.reset(a_keys, b_keys)
+                g_tables = GarbledTable.load(table)
+                for level in evaluator.levels:
+                    evaluator.evaluate(level, g_tables, level)
+                result = evaluator.decode({int(k): v for k, v in p_bits.items()})
+                results.append({str(k): v for k, v in result.items()})
+        metrics.count('gates', len(evaluator.gates) * num_instances, phase='evaluate')
+        return {'results': results}
+
+    def evaluate_chunks(self, evaluator, chunk_size):
+        # Evaluates the garbled tables as they are streamed by the garbler
+        output_p_bits = {}
+        for positions in chunk_levels(evaluator.levels, chunk_size):
+            data = self.client.receive()['kwargs']
+            output_p_bits.update({int(k): v for k, v in data['output_p_bits'].items()})
+            with metrics.span('evaluate_chunk', engine=evaluator.engine.name):
+                evaluator.evaluate(positions, GarbledTable.load(data['table']), range(len(positions)))
+            metrics.count('gates', len(positions), phase='evaluate')
+        return evaluator.decode(output_p_bits)
@@ -1,19 +1,34 @@
-from mpc.server._transport import SocketTransport
+import asyncio
+
+from mpc.server._lifecycle import Lifecycle
+from mpc.server._transport import MAX_WORKERS, AsyncTransport, SocketTransport
 
 
 class Server(object):
 
-    def __init__(self):
+    def __init__(self, asynchronous=False, max_workers=MAX_WORKERS, lifecycle=None):
         self.transport = None
+        self.lifecycle = lifecycle  # shared by the sessions, created at start up by default
+        # serve concurrent sessions with the asyncio transport
+        self.asynchronous = asynchronous
+        self.max_workers = max_workers
 
     def run(self, host='127.0.0.1', port=8080):
-        self.transport = SocketTransport(host, port)
+        self.lifecycle = self.lifecycle or Lifecycle()
+        try:
+            self.serve(host, port)
+        finally:
+            self.lifecycle.close()
+
+    def serve(self, host, port):
+        if self.asynchronous:
+            self.transport = AsyncTransport(host, port, self.max_workers, self.lifecycle)
+            asyncio.run(self.transport.run())
+            return
 
-        while True:
-            self.transport.connect()
+        self.transport = SocketTransport(host, port, self.lifecycle)
+        try:
             while True:
-                try:
-                    self.transport.receive()
-                except ConnectionAbortedError:
-                    self.transport.close()
-                    break
+                self.transport.receive()
+        finally:
+            self.transport.close()
@@ -1,34 +1,188 @@
+import asyncio
+import collections
+import functools
+import logging
+import selectors
 import socket
+from concurrent.futures import ThreadPoolExecutor
 
-from mpc.common.connection import marshall_response, unmarshall_request
-from mpc.server._context import Context
-from mpc.server._factories import ProtocolFactory
+from mpc.common.connection import (BUFFER_SIZE, END, SessionChannel, marshall_end, marshall_response, read_frame,
+                                   receive_envelope, receive_frame, send_message, unmarshall_request)
+from mpc.server._lifecycle import Lifecycle
+
+# threads running the protocols of the sessions, which block while waiting for the other party
+MAX_WORKERS = 256
+
+logger = logging.getLogger(__name__)
 
 
 class SocketTransport(object):
+    """
+        Serves the requests of all its connections one at a time. The sessions
+        of a connection each get their own Context and SessionChannel: while a
+        request waits for the other party, the frames of the other sessions
+        are queued on their channels, and their requests are served afterwards.
+        A session whose request fails is ended with an END frame.
+    """
 
-    def __init__(self, host, port):
-        self.context = None
+    def __init__(self, host, port, lifecycle=None):
+        self.lifecycle = lifecycle or Lifecycle()
+        self.sessions = {}  # (socket, session id) -> (SessionChannel, Context)
+        self.ready = collections.deque()  # (socket, session id) of the frames queued, in order of arrival
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.bind((host, port))
-        self.s.listen(1)
-        self.socket = None
+        self.s.listen()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.s, selectors.EVENT_READ)
+        self.buffer = bytearray(BUFFER_SIZE)
+
+    def receive(self):
+        # serves the oldest request queued, reading the connections until there is one
+        while True:
+            while self.ready:
+                key = self.ready.popleft()
+                # frames read while a request waited for them are already consumed
+                if key in self.sessions and not self.sessions[key][0].frames.empty():
+                    return self.serve(key)
+            for event, _ in self.selector.select():
+                if event.fileobj is self.s:
+                    self.connect()
+                else:
+                    self.route(event.fileobj)
 
     def connect(self):
-        self.socket, client = self.s.accept()
-        # TODO should be initialized and injected differently,
-        #  maybe it has a lifecycle manager that copies objects clears
-        #  and override attributes
-        self.context = Context(self.socket)
+        sock, client = self.s.accept()
+        self.selector.register(sock, selectors.EVENT_READ)
 
-    def receive(self):
-        data = self.socket.recv(10000)
-        if not data:
-            raise ConnectionAbortedError
-        protocol, method, data = unmarshall_request(data)
-        response = self.context.handle(protocol, method, **data)
-        data = marshall_response(**response)
-        self.socket.send(data)
+    def route(self, sock):
+        # reads one frame of a connection into the channel of its session
+        try:
+            message_type, session_id, frame = receive_frame(sock)
+        except OSError:
+            return self.disconnect(sock)
+        key = sock, session_id
+        if message_type == END:
+            if key in self.sessions:
+                self.sessions.pop(key)[0].put(None)
+            return
+        if key not in self.sessions:
+            channel = SessionChannel(functools.partial(send_message, sock), read=functools.partial(self.route, sock))
+            self.sessions[key] = channel, self.lifecycle.context(channel, session_id)
+        self.sessions[key][0].put(frame)
+        self.ready.append(key)
+
+    def serve(self, key):
+        # serves one request of a session
+        sock, session_id = key
+        channel, context = self.sessions[key]
+        try:
+            _, _, request_id, data = receive_envelope(channel, self.buffer)
+            protocol, method, data = unmarshall_request(data)
+            frame = marshall_response(session_id, request_id, **context.handle(protocol, method, **data))
+        except ConnectionError:
+            return  # the session or its connection ended while the request waited for them
+        except Exception:
+            logger.exception("Session %d failed", session_id)
+            self.sessions.pop(key, None)
+            frame = marshall_end(session_id)
+        try:
+            send_message(sock, frame)
+        except OSError:
+            pass  # the connection is dropped once its end is read
+
+    def disconnect(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+        for key in [key for key in self.sessions if key[0] is sock]:
+            self.sessions.pop(key)[0].put(None)
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+class AsyncTransport(object):
+    """
+        Serves many sessions concurrently, each with its own Context, whether
+        they have a connection each or share multiplexed connections.
+        Frames are read on the event loop and routed to the SessionChannel of
+        their session, whose protocols run in an executor thread for as long
+        as the session lasts and talk back to the other party through it.
+    """
+
+    def __init__(self, host, port, max_workers=MAX_WORKERS, lifecycle=None):
+        self.lifecycle = lifecycle or Lifecycle()
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.server = None
+
+    async def run(self):
+        self.server = await asyncio.start_server(self.session, self.host, self.port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def session(self, reader, writer):
+        loop = asyncio.get_event_loop()
+
+        def write(frame):
+            asyncio.run_coroutine_threadsafe(self._write(writer, frame), loop).result()
+
+        channels = {}  # session id -> SessionChannel
+        try:
+            while True:
+                message_type, session_id, frame = await read_frame(reader)
+                if message_type == END:
+                    channel = channels.pop(session_id, None)
+                    if channel is not None:
+                        channel.put(None)
+                    continue
+                channel = channels.get(session_id)
+                if channel is None or channel.closed:
+                    channel = channels[session_id] = SessionChannel(write)
+                    future = loop.run_in_executor(self.executor, self.serve, channel, session_id)
+                    future.add_done_callback(functools.partial(self._served, channels, session_id, channel))
+                channel.put(frame)
+        except (ConnectionAbortedError, ConnectionResetError):
+            pass
+        finally:
+            for channel in channels.values():
+                channel.put(None)
+            writer.close()
+
+    def serve(self, channel, session_id):
+        # runs the requests of a session until it ends, a failed request ends it with an END frame
+        buffer = bytearray(BUFFER_SIZE)
+        try:
+            context = self.lifecycle.context(channel, session_id)
+            while True:
+                _, _, request_id, data = receive_envelope(channel, buffer)
+                protocol, method, data = unmarshall_request(data)
+                response = context.handle(protocol, method, **data)
+                send_message(channel, marshall_response(session_id, request_id, **response))
+        except (ConnectionAbortedError, ConnectionResetError):
+            pass
+        except Exception:
+            logger.exception("Session %d failed", session_id)
+            # closed before the END is sent, the next frames of the id start a new session
+            channel.close()
+            send_message(channel, marshall_end(session_id))
+
+    @staticmethod
+    def _served(channels, session_id, channel, future):
+        # runs on the event loop once a session is over
+        if channels.get(session_id) is channel:
+            del channels[session_id]
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Session %d failed", session_id, exc_info=future.exception())
+
+    @staticmethod
+    async def _write(writer, frame):
+        writer.writelines(frame)
+        await writer.drain()
 
     def close(self):
-        self.socket.close()
+        if self.server:
+            self.server.close()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,38 @@
+import pytest
+
+from mpc.common.circuit import levelize
+
+OPERATIONS = {
+    "AND": lambda a, b: a & b,
+    "OR": lambda a, b: a | b,
+    "XOR": lambda a, b: a ^ b,
+    "NAND": lambda a, b: 1 - (a & b),
+    "NOR": lambda a, b: 1 - (a | b),
+    "XNOR": lambda a, b: 1 - (a ^ b),
+    "NOT": lambda a: 1 - a,
+    "BUF": lambda a: a,
+}
+
+
+def evaluate_plain(circuit, inputs):
+    """
+    Evaluate a circuit spec in the clear.
+        Parameters:
+            circuit: dict
+                circuit spec
+            inputs: bits of Alice's then Bob's input wires
+        Returns:
+            outputs: list of the bits of the output wires
+    """
+    values = dict(zip(circuit["alice"] + circuit["bob"], inputs))
+    values.update({int(wire): bit for wire, bit in circuit.get("const", {}).items()})
+    for level in levelize(circuit["gates"]):
+        for position in level:
+            gate = circuit["gates"][position]
+            values[gate["id"]] = OPERATIONS[gate["type"]](*[values[wire] for wire in gate["in"]])
+    return [values[wire] for wire in circuit["out"]]
+
+
+@pytest.fixture
+def evaluate():
+    return evaluate_plain
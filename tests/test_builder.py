@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+from mpc.common.builder import KARATSUBA_MIN_BITS, build_circuit, load_builtin
+
+REFERENCES = {
+    "add": lambda x, y, n: x + y,
+    "add_lookahead": lambda x, y, n: x + y,
+    "sub": lambda x, y, n: (x - y) % (1 << n),
+    "gt": lambda x, y, n: int(x > y),
+    "eq": lambda x, y, n: int(x == y),
+    "mul": lambda x, y, n: x * y,
+}
+# Karatsuba from KARATSUBA_MIN_BITS, with even and odd splits
+WIDTHS = [1, 2, 3, 8, 13, KARATSUBA_MIN_BITS, KARATSUBA_MIN_BITS + 1, 32, 33]
+
+
+def bits(value, num_bits):
+    return [(value >> i) & 1 for i in range(num_bits)]
+
+
+def number(outputs):
+    return sum(bit << i for i, bit in enumerate(outputs))
+
+
+def operands(num_bits, rand):
+    if num_bits <= 3:
+        return [(x, y) for x in range(1 << num_bits) for y in range(1 << num_bits)]
+    top = (1 << num_bits) - 1
+    pairs = [(0, 0), (top, top), (top, 0), (0, top), (top, top - 1)]
+    return pairs + [(rand.getrandbits(num_bits), rand.getrandbits(num_bits)) for _ in range(30)]
+
+
+@pytest.mark.parametrize("name", sorted(REFERENCES))
+@pytest.mark.parametrize("num_bits", WIDTHS)
+def test_gadget(evaluate, name, num_bits):
+    circuit = build_circuit(name, num_bits)
+    for x, y in operands(num_bits, random.Random(num_bits)):
+        outputs = evaluate(circuit, bits(x, num_bits) + bits(y, num_bits))
+        assert number(outputs) == REFERENCES[name](x, y, num_bits), (x, y)
+
+
+@pytest.mark.parametrize("num_bits", [1, 4, 9])
+def test_mux(evaluate, num_bits):
+    circuit = build_circuit("mux", num_bits)
+    rand = random.Random(num_bits)
+    for _ in range(30):
+        s, x, y = rand.getrandbits(1), rand.getrandbits(num_bits), rand.getrandbits(num_bits)
+        outputs = evaluate(circuit, [s] + bits(x, num_bits) + bits(y, num_bits))
+        assert number(outputs) == (y if s else x)
+
+
+def test_unknown_circuit():
+    with pytest.raises(ValueError):
+        build_circuit("div", 8)
+
+
+def test_load_builtin_cache(tmpdir):
+    compiled = load_builtin("add", 8, cache_dir=str(tmpdir))
+    cached = load_builtin("add", 8, cache_dir=str(tmpdir))
+    assert cached.spec()["gates"] == compiled.spec()["gates"]
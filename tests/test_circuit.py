@@ -0,0 +1,76 @@
+import itertools
+import random
+
+import pytest
+
+from mpc.common.circuit import CompiledCircuit, optimize_circuit
+from mpc.common.protocols import GarbledCircuit
+
+GATES = ["AND", "OR", "XOR", "NAND", "NOR", "XNOR", "NOT", "NOT", "BUF"]
+
+
+def random_circuit(rand):
+    num_inputs = rand.randint(1, 4)
+    wires = list(range(2 * num_inputs))
+    const = {}
+    for _ in range(rand.randint(0, 2)):
+        const[str(len(wires))] = rand.randint(0, 1)
+        wires.append(len(wires))
+    gates = []
+    for _ in range(rand.randint(1, 30)):
+        gate_type = rand.choice(GATES)
+        gate_in = [rand.choice(wires) for _ in range(1 if gate_type in ("NOT", "BUF") else 2)]
+        gates.append({"id": len(wires), "type": gate_type, "in": gate_in})
+        wires.append(len(wires))
+    return {
+        "name": "random",
+        "alice": list(range(num_inputs)),
+        "bob": list(range(num_inputs, 2 * num_inputs)),
+        "const": const,
+        "out": [rand.choice(wires) for _ in range(rand.randint(1, 4))],
+        "gates": gates,
+    }
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_optimize_keeps_outputs(evaluate, seed):
+    rand = random.Random(seed)
+    for _ in range(200):
+        circuit = random_circuit(rand)
+        optimized, report = optimize_circuit(circuit)
+        num_inputs = len(circuit["alice"]) + len(circuit["bob"])
+        for inputs in itertools.product((0, 1), repeat=num_inputs):
+            assert evaluate(optimized, inputs) == evaluate(circuit, inputs)
+        assert report["gates"] == [len(circuit["gates"]), len(optimized["gates"])]
+        assert report["removed"] >= 0
+
+
+def test_optimize_output_listed_twice(evaluate):
+    circuit = {
+        "name": "nand",
+        "alice": [0],
+        "bob": [1],
+        "out": [3, 3],
+        "gates": [{"id": 2, "type": "AND", "in": [0, 1]}, {"id": 3, "type": "NOT", "in": [2]}],
+    }
+    optimized, report = optimize_circuit(circuit)
+    ids = [gate["id"] for gate in optimized["gates"]]
+    assert len(ids) == len(set(ids))
+    assert report["removed"] == 1
+    for inputs in itertools.product((0, 1), repeat=2):
+        assert evaluate(optimized, inputs) == evaluate(circuit, inputs)
+    CompiledCircuit.compile(optimized)
+    GarbledCircuit(optimized)
+
+
+def test_optimize_folds_constants():
+    circuit = {
+        "name": "constant",
+        "alice": [0],
+        "bob": [1],
+        "const": {"2": 0},
+        "out": [4],
+        "gates": [{"id": 3, "type": "AND", "in": [0, 2]}, {"id": 4, "type": "XOR", "in": [3, 1]}],
+    }
+    optimized, report = optimize_circuit(circuit)
+    assert report["non_free_gates"] == [1, 0]